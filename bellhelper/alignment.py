@@ -0,0 +1,122 @@
+'''
+Runs the mirror alignments of several labs concurrently. Jobs that
+optimize different counters (e.g. effA on Alice's path, effB on Bob's and
+effAB in the source) don't disturb each other's objective and run in
+parallel. Jobs that share a counter, or a MirrorControl, run one after
+another in the same thread. While the jobs run, every read is served from
+one in-process stream cache, so concurrent jobs share the same tail of the
+counts stream and see the same sample windows.
+
+    jobs = [AlignmentJob(zSource, 'Both', 'effAB'),
+            AlignmentJob(zAlice, 'VPath', 'effA'),
+            AlignmentJob(zBob, 'VPath', 'effB')]
+    results = align_all(jobs, r)
+'''
+import threading
+import time
+
+try:
+    import bellhelper.read as read
+except Exception:
+    import read as read
+
+
+class AlignmentJob():
+    """One call of controller.optimize_eff and its outcome."""
+
+    def __init__(self, controller, path, countType='effAB', dir='xy',
+                 COUNTPATH='VV', method='Nelder-Mead', name=None):
+        self.controller = controller
+        self.path = path
+        self.countType = countType
+        self.dir = dir
+        self.COUNTPATH = COUNTPATH
+        self.method = method
+        if name is None:
+            name = '%s %s' % (getattr(controller, 'name', ''), path)
+        self.name = name
+        self.startPos = None
+        self.bestPos = None
+        self.elapsed = None
+        self.error = None
+
+    def get_counter(self):
+        '''Jobs with the same counter can't be optimized at the same
+        time.'''
+        return (self.countType, self.COUNTPATH)
+
+    def run(self, q=None):
+        t0 = time.time()
+        try:
+            self.startPos = self.controller.get_all_positions()
+            self.controller.optimize_eff(self.path,
+                                         countType=self.countType,
+                                         dir=self.dir,
+                                         COUNTPATH=self.COUNTPATH, q=q,
+                                         method=self.method)
+            self.bestPos = self.controller.BESTPOS
+        except Exception as e:
+            self.error = e
+            print('Alignment of', self.name, 'failed:', e)
+        self.elapsed = time.time() - t0
+        return self
+
+    def get_result(self):
+        return {'name': self.name, 'countType': self.countType,
+                'path': self.path, 'startPos': self.startPos,
+                'bestPos': self.bestPos, 'elapsed': self.elapsed,
+                'error': None if self.error is None else str(self.error)}
+
+
+def group_jobs(jobs):
+    '''
+    Splits jobs into groups that can run concurrently. Jobs that share a
+    counter or a controller (whose optimizer state isn't thread safe) end
+    up in the same group, in their original order.
+    '''
+    groups = []
+    for job in jobs:
+        shared = [g for g in groups
+                  if any((other.get_counter() == job.get_counter()) or
+                         (other.controller is job.controller)
+                         for other in g)]
+        merged = [job]
+        for g in shared:
+            groups.remove(g)
+            merged = g + merged
+        merged.sort(key=jobs.index)
+        groups.append(merged)
+    return groups
+
+
+def align_all(jobs, r=None, use_stream_cache=True, q=None):
+    '''
+    Runs the jobs, concurrently across counters and in order within each
+    counter, and returns the list of job results in the order given.
+    r: Redis connection (or config dict) used by the jobs. If given and
+       use_stream_cache is True, a shared stream cache is started for the
+       duration of the run unless one is already running.
+    '''
+    cacheStarted = False
+    if (r is not None) and use_stream_cache:
+        if read.streamCache.get_stream_cache(r) is None:
+            read.enable_stream_cache(r)
+            cacheStarted = True
+
+    def run_group(group):
+        for job in group:
+            job.run(q)
+
+    threads = []
+    try:
+        for group in group_jobs(jobs):
+            t = threading.Thread(target=run_group, args=(group,),
+                                 daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    finally:
+        if cacheStarted:
+            read.disable_stream_cache(r)
+    return [job.get_result() for job in jobs]
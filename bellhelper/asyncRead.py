@@ -0,0 +1,177 @@
+'''
+asyncio versions of the read functions, built on redis.asyncio. They use
+the same error-check and aggregation functions as read, but wait for new
+stream entries with non-blocking awaits, so many alignment and monitoring
+tasks can acquire counts concurrently on one event loop:
+
+    counts, stats = await asyncio.gather(
+        asyncRead.get_counts(r, int_time=1.),
+        asyncRead.get_stats(r, int_time=1.))
+'''
+import asyncio
+import math
+import weakref
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+try:
+    import bellhelper.read as read
+    import bellhelper.redisHelper as rh
+    import bellhelper.streamExceptions as stExcept
+except Exception:
+    import read as read
+    import redisHelper as rh
+    import streamExceptions as stExcept
+
+# Async clients are bound to the event loop they were created on, so they
+# are shared per loop and then per server. Keying on the loop object itself
+# drops its clients when the loop is garbage collected.
+ASYNCCLIENTS = weakref.WeakKeyDictionary()
+
+
+def connect_to_redis(redisConfig):
+    if aioredis is None:
+        raise ImportError('redis.asyncio is not available, '
+                          'redis>=4.2 is required')
+    return aioredis.Redis(host=redisConfig['ip'],
+                          port=int(redisConfig['port']),
+                          db=int(redisConfig.get('db', 0)),
+                          health_check_interval=rh.HEALTHCHECKINTERVAL)
+
+
+def get_redis(r):
+    '''Accepts either an async redis connection or a redis config
+    dictionary and returns the shared async connection on the running
+    event loop for the latter.'''
+    if not isinstance(r, dict):
+        return r
+    loop = asyncio.get_running_loop()
+    # A client may keep its loop alive, so also drop those of closed loops
+    for oldLoop in [lp for lp in ASYNCCLIENTS.keys() if lp.is_closed()]:
+        ASYNCCLIENTS.pop(oldLoop, None)
+    clients = ASYNCCLIENTS.get(loop)
+    if clients is None:
+        clients = {}
+        ASYNCCLIENTS[loop] = clients
+    key = (r['ip'], int(r['port']), int(r.get('db', 0)))
+    client = clients.get(key)
+    if client is None:
+        client = connect_to_redis(r)
+        clients[key] = client
+    return client
+
+
+async def get_last_entry(r, channel, count=1):
+    msg = await r.xrevrange(channel, count=count)
+    if len(msg) == 0:
+        return None
+    return [(ele[0].decode(), rh.decode_dict(ele[1])) for ele in msg]
+
+
+async def get_data(r, channel, lastTimeStamp, count=None, block=None):
+    msg = await r.xread({channel: lastTimeStamp}, count=count, block=block)
+    if len(msg) == 0:
+        return None
+    return rh.decode_data(msg[0])
+
+
+async def loop_counts(r, channel, error_function, errorArgs, intTime=0.2,
+                      numTries=-1, sleepTime=0.05, timeOut=None, block=True,
+                      blockTime=None, startTime=None):
+    '''
+    Awaitable redisHelper.loop_counts with the same arguments and
+    exceptions. The blocking XREAD only occupies a connection, not the
+    event loop.
+    '''
+    msgCounts = await get_last_entry(r, channel, count=1)
+    if msgCounts is None:
+        raise stExcept.StreamFrozenException(channel, numTries=0,
+                                             timeElapsed=0)
+    lastTimeStamp = msgCounts[0][0]
+    defaultIntegrationTime = msgCounts[0][1]['integrationTime']
+
+    nSamples = int(math.ceil(float(intTime)/float(defaultIntegrationTime)))
+
+    if block and (blockTime is None):
+        blockTime = 2.*float(defaultIntegrationTime)
+
+    watchdog = rh.ReadWatchdog(channel, numTries=numTries, timeOut=timeOut,
+                               sleepTime=sleepTime, block=block)
+    countList = []
+    previousCounts = None
+    while len(countList) < nSamples:
+        if block:
+            wait = watchdog.wait_time(blockTime)
+            msgCounts = await get_data(r, channel, lastTimeStamp,
+                                       block=max(int(1000*wait), 1))
+        else:
+            await asyncio.sleep(sleepTime)
+            msgCounts = await get_data(r, channel, lastTimeStamp)
+
+        if msgCounts is None:
+            watchdog.empty_read()
+            continue
+
+        watchdog.new_entries()
+        previousCounts, lastTimeStamp = rh.filter_samples(
+            msgCounts, previousCounts, error_function, errorArgs, countList,
+            nSamples, startTime=startTime)
+
+    return countList
+
+
+async def get_counts(r, int_time=0.2, count_path='VV',
+                     include_null_counts=False, trim=True, loop_args={}):
+    '''See read.get_counts.'''
+    r = get_redis(r)
+    err_check_args = {'count_path': count_path,
+                      'include_null_counts': include_null_counts,
+                      'trim': trim}
+    count_list = await loop_counts(
+        r, read.CHANNELCOUNTS, read.error_check_counts, err_check_args,
+        intTime=int_time, **loop_args)
+    return read.aggregate_counts(count_list, count_path)
+
+
+async def get_violation(r, int_time=0.2, count_path='VV',
+                        include_null_counts=False, trim=True, loop_args={}):
+    '''See read.get_violation.'''
+    r = get_redis(r)
+    err_check_args = {'count_path': count_path,
+                      'include_null_counts': include_null_counts,
+                      'trim': trim}
+    count_list = await loop_counts(
+        r, read.CHANNELVIOLATION, read.error_check_violation,
+        err_check_args, intTime=int_time, **loop_args)
+    return read.aggregate_violation(count_list, count_path)
+
+
+async def get_stats(r, int_time=0.5, include_null_counts=False,
+                    extended_checks=False, extended_check_args={},
+                    loop_args={}, det_channels={}):
+    '''See read.get_stats.'''
+    r = get_redis(r)
+    err_check_args = {'include_null_counts': include_null_counts,
+                      'extended_checks': extended_checks,
+                      'extended_check_args': extended_check_args,
+                      'det_chnls': det_channels}
+    count_list = await loop_counts(
+        r, read.CHANNELSTATS, read.error_check_stats, err_check_args,
+        intTime=int_time, **loop_args)
+    return read.aggregate_stats(count_list)
+
+
+async def get_power(redis_db, int_time, COUNTTYPE='SB', COUNTPATH='VV',
+                    include_null_counts=False, trim=True, loop_args={}):
+    '''See read.get_power.'''
+    if COUNTPATH == 'All':
+        return await get_counts(redis_db, int_time=int_time,
+                                include_null_counts=include_null_counts,
+                                trim=trim, loop_args=loop_args)
+    counts = await get_counts(redis_db, int_time=int_time,
+                              count_path=COUNTPATH,
+                              include_null_counts=include_null_counts,
+                              trim=trim, loop_args=loop_args)
+    return read.select_count_type(counts[COUNTPATH], COUNTTYPE)
@@ -103,6 +103,45 @@ def find_coincidences(ch1Data, ch2Data, radius):
     return [singlesCh1, singlesCh2, coincidences]
 
 
+@jit(nopython=True, cache=True)
+def find_coincidence_diffs(ch1Data, ch2Data, radius):
+    '''
+    Same search as find_coincidences, but returns the timetag difference
+    ch1 - ch2 of every matched pair instead of just the number of
+    coincidences. Used to track the drift of the timetag offset between
+    Alice and Bob.
+    '''
+    singlesCh1 = len(ch1Data)
+    singlesCh2 = len(ch2Data)
+
+    diffs = np.zeros(min(singlesCh1, singlesCh2))
+    coincidences = 0
+    ch2Indx = 0
+    for i in range(singlesCh1):
+        ch1TTAG = ch1Data[i]
+        upper = ch1TTAG + radius
+        lower = ch1TTAG - radius
+        search = True
+
+        while search:
+            if ch2Indx >= singlesCh2:
+                search = False
+                break
+
+            ch2TTAG = ch2Data[ch2Indx]
+            if ch2TTAG < lower:
+                ch2Indx += 1
+            if ch2TTAG > upper:
+                search = False
+            if (ch2TTAG >= lower) & (ch2TTAG <= upper):
+                search = False
+                diffs[coincidences] = 1.*ch1TTAG - 1.*ch2TTAG
+                coincidences += 1
+                ch2Indx += 1
+
+    return diffs[0:coincidences]
+
+
 def trim_data(data, ttagOffset, abDelay, syncTTagDiff, params, dt=None):
     err = False
     trimmedData = {'alice': {}, 'bob': {}}
@@ -329,7 +368,13 @@ def calc_phase_histogram(laserPeriod, phase, clickBool):
     return phaseHist, pkIdx
 
 
-def calc_coinc_window_mask(det, params, divider, pkIdx='auto', ):
+def calc_coinc_window_mask(det, params, divider, pkIdx='auto',
+                           accumulator=None, tag=None):
+    '''
+    If an accumulator (phasetracker.PhaseHistogramAccumulator) is passed,
+    the phase histogram and peak are taken from its decaying accumulated
+    state instead of from this data alone.
+    '''
     divider = divider*1.
     ch = params['channels']
     radius = params['radius']
@@ -337,7 +382,11 @@ def calc_coinc_window_mask(det, params, divider, pkIdx='auto', ):
 
     phase, laserPulse, ttagModSync, laserPeriod = calc_phase_info(
         det, divider, ch)
-    phaseHist, pk = calc_phase_histogram(laserPeriod, phase, clickBool)
+    if accumulator is None:
+        phaseHist, pk = calc_phase_histogram(laserPeriod, phase, clickBool)
+    else:
+        phaseHist, pk = accumulator.add_phase(laserPeriod, phase, clickBool,
+                                              tag=tag)
     # print(phaseHist)
 
     if (pkIdx is True) or (pkIdx is None):
@@ -368,19 +417,32 @@ def calc_coinc_window_mask(det, params, divider, pkIdx='auto', ):
 # @jit
 
 
-def calc_data_properties(data, params, divider, findPk=False):
+def calc_data_properties(data, params, divider, findPk=False,
+                         accumulators=None, tag=None):
+    '''
+    accumulators: optional dictionary of phase histogram accumulators keyed
+                  by party, used to accumulate the phase and laser-pulse
+                  histograms across updates when findPk is True.
+    tag:          identifies the update the data belongs to.
+    '''
     props = {}
     for party in data:
         det = data[party]
         p = params[party]
+        accumulator = None
+        if accumulators is not None:
+            accumulator = accumulators.get(party)
         # print('properties', p, det)
         props[party] = calc_data_properties_one_party(det, p, divider,
-                                                      findPk=findPk, party=party)
+                                                      findPk=findPk, party=party,
+                                                      accumulator=accumulator,
+                                                      tag=tag)
     return props
 
 
 def calc_data_properties_one_party(data, params, divider,
-                                   findPk=False, party=''):
+                                   findPk=False, party='',
+                                   accumulator=None, tag=None):
 
     props = {}
     ch = params['channels']
@@ -408,8 +470,10 @@ def calc_data_properties_one_party(data, params, divider,
         pkIdx = True
     else:
         pkIdx = params['pkIdx']
+    if not findPk:
+        accumulator = None
     inWindowMask, laserPulse, phaseHist = calc_coinc_window_mask(
-        det, params, divider, pkIdx=pkIdx)
+        det, params, divider, pkIdx=pkIdx, accumulator=accumulator, tag=tag)
     phaseHist['name'] = party
 
     # Compute the FWHM
@@ -418,8 +482,12 @@ def calc_data_properties_one_party(data, params, divider,
     except Exception:
         fwhm = 0.
 
-    laserPulseHist = laser_pulse_histogram(
-        laserPulse, inWindowMask, clickBool, divider)
+    if accumulator is None:
+        laserPulseHist = laser_pulse_histogram(
+            laserPulse, inWindowMask, clickBool, divider)
+    else:
+        laserPulseHist = accumulator.add_laser_pulse(
+            laserPulse, inWindowMask, clickBool, divider, tag=tag)
 
     props['divider'] = divider
     props['syncArray'] = syncArray
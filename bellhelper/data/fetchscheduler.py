@@ -0,0 +1,139 @@
+'''
+Adaptive scheduling of the live timetagger fetches. Keeps a short history
+of how long each party takes to return its data and whether the resulting
+update could be trimmed, and uses that to pick the fetch margin and the
+time to wait before the next request.
+
+Each timetagger returns the last dt + margin seconds of tags at the moment
+it serves its request. trim_data starts the window at the later of the two
+first tags and needs dt seconds of overlap after it, so what eats into the
+margin is how far apart in time the two parties' windows were cut. That is
+the difference between their fetch latencies, not the latencies themselves:
+a latency common to both shifts both windows equally. The margin is
+therefore taken from the spread in latency between the parties at the
+target quantile, scaled by a gain that makes up for the spread the history
+underestimates (it grows on each failed trim).
+'''
+import time
+from collections import deque
+import numpy as np
+
+
+class FetchScheduler():
+    """
+    Tracks per-party fetch latencies and the trim success rate of recent
+    updates. The margin added on top of the integration time is taken from
+    the spread in latency between the parties at the target completeness
+    quantile, scaled by a gain that grows on every failed trim, up to
+    maxMargin/minMargin, and relaxes slowly on successful ones.
+    """
+
+    def __init__(self, parties=('alice', 'bob'), target=0.95,
+                 minMargin=0.075, maxMargin=0.2, historyLength=100,
+                 minSamples=10):
+        self.parties = tuple(parties)
+        self.target = target
+        self.minMargin = minMargin
+        self.maxMargin = maxMargin
+        self.minSamples = minSamples
+        self.historyLength = historyLength
+        self.gain = 1.
+        self.gainUp = 1.5
+        self.gainDown = 0.97
+        # Beyond this the margin is pinned at maxMargin for any spread of
+        # at least minMargin, so a higher gain would only delay recovery.
+        self.maxGain = max(1., maxMargin/minMargin)
+        self.lastFetchStart = None
+        self.reset()
+
+    def reset(self):
+        self.latency = {}
+        for p in self.parties:
+            self.latency[p] = deque(maxlen=self.historyLength)
+        self.trimHistory = deque(maxlen=self.historyLength)
+        self.gain = 1.
+
+    def default_margin(self, dt):
+        '''The fixed margin used before any latencies have been recorded.'''
+        margin = min(0.4*dt, 0.2)
+        margin = max(margin, 0.075)
+        return margin
+
+    def record_latency(self, party, latency):
+        if party not in self.latency:
+            self.latency[party] = deque(maxlen=self.historyLength)
+        self.latency[party].append(float(latency))
+
+    def record_result(self, isTrim):
+        '''
+        Record whether the last update produced trimmed data and adjust
+        the margin gain accordingly.
+        '''
+        isTrim = bool(isTrim)
+        self.trimHistory.append(isTrim)
+        if isTrim:
+            self.gain = max(1., self.gain*self.gainDown)
+        else:
+            self.gain = min(self.maxGain, self.gain*self.gainUp)
+
+    def completeness(self):
+        '''Fraction of recent updates for which the data could be trimmed.'''
+        if len(self.trimHistory) == 0:
+            return None
+        return np.mean(self.trimHistory)
+
+    def latency_stats(self):
+        '''
+        Returns a dictionary with the number of samples, mean, median and
+        target quantile of the fetch latency for each party.
+        '''
+        stats = {}
+        for p, lat in self.latency.items():
+            if len(lat) == 0:
+                stats[p] = None
+                continue
+            latArray = np.array(lat)
+            stats[p] = {'n': len(latArray),
+                        'mean': float(np.mean(latArray)),
+                        'median': float(np.median(latArray)),
+                        'quantile': float(np.quantile(latArray,
+                                                      self.target))}
+        return stats
+
+    def latency_spread(self):
+        '''
+        The spread between the parties' latencies at the target quantile,
+        i.e. how much later one party's data window may end compared to
+        the other's. Returns None until enough samples are available.
+        '''
+        n = min([len(self.latency[p]) for p in self.parties])
+        if n < self.minSamples:
+            return None
+        lat = np.array([list(self.latency[p])[-n:] for p in self.parties])
+        spread = np.max(lat, axis=0) - np.min(lat, axis=0)
+        return float(np.quantile(spread, self.target))
+
+    def get_margin(self, dt):
+        '''
+        Margin in seconds to fetch on top of the integration time dt.
+        '''
+        spread = self.latency_spread()
+        if spread is None:
+            return self.default_margin(dt)
+        margin = spread*self.gain
+        margin = min(margin, self.maxMargin)
+        margin = max(margin, self.minMargin)
+        return margin
+
+    def get_sleep_time(self, dt):
+        '''
+        Time to wait before the next fetch so that consecutive requests are
+        spaced by dt instead of dt plus the fetch and analysis time.
+        '''
+        if self.lastFetchStart is None:
+            return dt
+        elapsed = time.time() - self.lastFetchStart
+        return max(0., dt - elapsed)
+
+    def mark_fetch_start(self):
+        self.lastFetchStart = time.time()
@@ -0,0 +1,99 @@
+'''
+Incremental tracking of the timetag offset between Alice and Bob. Rather
+than re-running the full offset search in find_sync_offset2 whenever the
+clocks drift apart, the mean timing difference of the coincidences found
+in each update is used to nudge ttagOffset. The estimate is kept as a
+float, and the integer offset applied to the data only changes once the
+estimate has moved a whole timetag bin away from it, so it doesn't flip
+between neighbouring offsets.
+'''
+import numpy as np
+
+
+class OffsetTracker():
+    """
+    Follows the drift of ttagOffset from the timing differences (in
+    timetag bins) between matched Alice and Bob detections.
+
+    gain:           Fraction of the measured mean residual applied per update.
+    minCoinc:       Minimum number of coincidences (after outlier rejection)
+                    needed before the offset is updated.
+    outlierScale:   Differences further than outlierScale robust standard
+                    deviations from the median are rejected.
+    alarmThreshold: If the tracked offset moves more than this many bins
+                    away from the last full offset search, the alarm is set
+                    and a new search should be run. The warning is printed
+                    once each time the alarm is set.
+    """
+
+    def __init__(self, gain=0.2, minCoinc=20, outlierScale=3.,
+                 alarmThreshold=20.):
+        self.gain = gain
+        self.minCoinc = minCoinc
+        self.outlierScale = outlierScale
+        self.alarmThreshold = alarmThreshold
+        self.reset(None)
+
+    def reset(self, offset):
+        '''Restart tracking from a newly measured offset.'''
+        if offset is None:
+            self.offset = None
+            self.referenceOffset = None
+            self.applied = None
+        else:
+            self.offset = float(offset)
+            self.referenceOffset = float(offset)
+            self.applied = int(round(offset))
+        self.lastResidual = 0.
+        self.lastNCoinc = 0
+        self.alarm = False
+
+    def reject_outliers(self, diffs):
+        diffs = np.asarray(diffs, dtype=float)
+        if len(diffs) == 0:
+            return diffs
+        med = np.median(diffs)
+        # 1.4826 converts the median absolute deviation to a standard
+        # deviation for normally distributed jitter.
+        sigma = 1.4826*np.median(np.abs(diffs - med))
+        if sigma == 0:
+            return diffs
+        mask = np.abs(diffs - med) <= self.outlierScale*sigma
+        return diffs[mask]
+
+    def update(self, diffs, offset):
+        '''
+        diffs:  Alice - Bob timetag differences of the matched coincidences,
+                measured with the current offset already applied.
+        offset: The offset that was applied to Bob's timetags.
+        Returns the integer offset to apply to the next update.
+        '''
+        if (self.offset is None) or (self.applied != int(offset)):
+            # Offset changed externally, e.g. by a new offset search.
+            self.reset(offset)
+
+        diffs = self.reject_outliers(diffs)
+        self.lastNCoinc = len(diffs)
+        if len(diffs) < self.minCoinc:
+            return self.applied
+
+        self.lastResidual = float(np.mean(diffs))
+        self.offset += self.gain*self.lastResidual
+        if abs(self.offset - self.applied) >= 1:
+            self.applied = int(round(self.offset))
+
+        drift = self.offset - self.referenceOffset
+        wasAlarm = self.alarm
+        self.alarm = abs(drift) > self.alarmThreshold
+        if self.alarm and not wasAlarm:
+            print('ttagOffset has drifted by', drift,
+                  'bins since the last offset search')
+        return self.applied
+
+    def get_status(self):
+        status = {'offset': self.offset,
+                  'applied': self.applied,
+                  'residual': self.lastResidual,
+                  'nCoinc': self.lastNCoinc,
+                  'alarm': int(self.alarm)}
+        return status
@@ -0,0 +1,92 @@
+'''
+Exponentially-weighted phase and laser-pulse histograms. When the peak is
+being searched for every update (findPk), the phase histogram of a single
+0.2 s window is noisy on low-count paths. Accumulating it across updates
+with a decay keeps the peak and FWHM estimates stable while still
+following slow changes.
+'''
+import numpy as np
+
+
+class PhaseHistogramAccumulator():
+    """
+    Decaying phase and laser-pulse histograms for one party and detector.
+    decay is the weight kept from the previous updates, so the histograms
+    average over roughly 1/(1-decay) updates. New updates are weighted by
+    1-decay, so the histograms keep the scale of a single update's.
+
+    The histograms are kept as floats and returned rounded to integer
+    counts, as the per-update histograms are. The peak is found on the
+    unrounded values.
+
+    The tag argument of the add methods identifies the update the data
+    belongs to. Data with the same tag as the previous call is not added a
+    second time, which happens when the same detector is paired with
+    several detectors of the other party.
+    """
+
+    def __init__(self, decay=0.8):
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        self.phaseY = None
+        self.laserPulseY = None
+        self.phaseTag = None
+        self.laserPulseTag = None
+
+    def add_phase(self, laserPeriod, phase, clickBool, tag=None):
+        '''
+        Add the detection phases of one update and return the accumulated
+        phase histogram and its peak index.
+        '''
+        nBins = int(np.floor(laserPeriod)) - 1
+        if (tag is None) or (tag != self.phaseTag):
+            n = bin_counts(phase[clickBool], nBins)
+            if (self.phaseY is None) or (len(self.phaseY) != nBins):
+                self.phaseY = n.astype(float)
+            else:
+                self.phaseY = self.decay*self.phaseY + (1 - self.decay)*n
+            self.phaseTag = tag
+        x = np.arange(len(self.phaseY)) + 0.5
+        phaseHist = {'x': x, 'y': as_counts(self.phaseY)}
+        pkIdx = np.argmax(self.phaseY)
+        return phaseHist, pkIdx
+
+    def add_laser_pulse(self, laserPulse, inWindowMask, clickBool, divider,
+                        tag=None):
+        '''
+        Add the laser pulse numbers of the in-window detections of one
+        update and return the accumulated laser-pulse histogram.
+        '''
+        nBins = int(divider)
+        if (tag is None) or (tag != self.laserPulseTag):
+            n = bin_counts(laserPulse[inWindowMask & clickBool], nBins)
+            if ((self.laserPulseY is None) or
+                    (len(self.laserPulseY) != nBins)):
+                self.laserPulseY = n.astype(float)
+            else:
+                self.laserPulseY = (self.decay*self.laserPulseY +
+                                    (1 - self.decay)*n)
+            self.laserPulseTag = tag
+        laserPulseHist = {'x': np.arange(nBins),
+                          'y': as_counts(self.laserPulseY), 'name': ''}
+        return laserPulseHist
+
+
+def bin_counts(vals, nBins):
+    '''
+    Histogram of vals into unit-width bins [0, 1), [1, 2), ...,
+    [nBins-1, nBins] using bincount, which is considerably cheaper than
+    np.histogram. As in np.histogram, the last bin includes its upper edge.
+    '''
+    vals = np.asarray(vals)
+    vals = vals[(vals >= 0) & (vals <= nBins)]
+    idx = np.minimum(np.floor(vals).astype(np.int64), nBins - 1)
+    return np.bincount(idx, minlength=nBins)
+
+
+def as_counts(y):
+    '''The accumulated histogram rounded to the integer dtype of the
+    per-update np.histogram counts.'''
+    return np.rint(y).astype(np.int64)
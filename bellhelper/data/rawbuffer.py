@@ -0,0 +1,86 @@
+'''
+Bounded in-memory buffer of the most recent raw timetags fetched by the
+live loop, so calibration routines can re-analyze data that has already
+been acquired instead of waiting for a fresh integration.
+'''
+from collections import deque
+import numpy as np
+
+try:
+    from bellhelper.data.coinclib import TTAGERRESOLUTION
+except Exception:
+    from coinclib import TTAGERRESOLUTION
+
+
+class RawDataBuffer():
+    """
+    Keeps up to maxChunks raw chunks per party, covering at most maxTime
+    seconds. Consecutive live fetches overlap by the fetch margin, so only
+    the timetags newer than the last buffered one are kept from each chunk.
+    """
+
+    def __init__(self, parties=('alice', 'bob'), maxTime=30., maxChunks=300):
+        self.parties = tuple(parties)
+        self.maxTime = maxTime
+        self.maxChunks = maxChunks
+        self.clear()
+
+    def clear(self):
+        self.chunks = {}
+        self.lastTTag = {}
+        for p in self.parties:
+            self.chunks[p] = deque(maxlen=self.maxChunks)
+            self.lastTTag[p] = None
+
+    def add(self, rawData):
+        '''Add the chunk of raw data fetched for each party.'''
+        for p, data in rawData.items():
+            if data is None or len(data) == 0:
+                continue
+            if p not in self.chunks:
+                self.chunks[p] = deque(maxlen=self.maxChunks)
+                self.lastTTag[p] = None
+            last = self.lastTTag[p]
+            if (last is not None) and (data['ttag'][-1] < last):
+                # The timetagger has been restarted; the old tags no
+                # longer share a time base with the new ones.
+                self.chunks[p].clear()
+                last = None
+            if last is not None:
+                data = data[data['ttag'] > last]
+                if len(data) == 0:
+                    continue
+            self.chunks[p].append(data)
+            self.lastTTag[p] = data['ttag'][-1]
+            self._drop_old(p)
+
+    def _drop_old(self, party):
+        chunks = self.chunks[party]
+        spanTTags = self.maxTime/TTAGERRESOLUTION
+        while len(chunks) > 1:
+            if self.lastTTag[party] - chunks[1]['ttag'][0] < spanTTags:
+                break
+            chunks.popleft()
+
+    def available_time(self, party):
+        '''Seconds of contiguous data buffered for a party.'''
+        chunks = self.chunks.get(party)
+        if not chunks:
+            return 0.
+        span = self.lastTTag[party] - chunks[0]['ttag'][0]
+        return span*TTAGERRESOLUTION
+
+    def get_data(self, intTime):
+        '''
+        Returns a dictionary with the last intTime seconds of raw data for
+        each party, or None if not enough data has been buffered.
+        '''
+        rawData = {}
+        spanTTags = intTime/TTAGERRESOLUTION
+        for p in self.parties:
+            if self.available_time(p) < intTime:
+                return None
+            data = np.concatenate(list(self.chunks[p]))
+            startTTag = self.lastTTag[p] - spanTTags
+            rawData[p] = data[data['ttag'] >= startTTag]
+        return rawData
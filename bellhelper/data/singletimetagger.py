@@ -18,6 +18,7 @@ class TimeTagger():
         self.connect()
         self.dataType = np.dtype([('ch', np.uint8), ('ttag', np.uint64)])
         self.filename = ''
+        self.lastTiming = {'transfer': 0., 'decompress': 0.}
         # print(self.sendMessage('commands'))
 
     def close(self):
@@ -115,8 +116,12 @@ class TimeTagger():
         return data
 
     def stream_server(self, dt=1):
+        t1 = time.perf_counter()
         binData = self.sendMessage('stream %f' % dt)
+        t2 = time.perf_counter()
         data = self.convert_data(binData)
+        t3 = time.perf_counter()
+        self.lastTiming = {'transfer': t2-t1, 'decompress': t3-t2}
         return(data)
 
     def get_stats(self, dt=0.5):
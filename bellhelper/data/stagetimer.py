@@ -0,0 +1,119 @@
+'''
+Lightweight timers for the stages of the live analysis loop. Durations
+are summed per cycle (one call to update or analyze_data), then added to
+a histogram per stage so that the time spent fetching, decompressing,
+trimming and computing the counts can be monitored in production.
+'''
+import time
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import bellhelper.redisHelper as rh
+except Exception:
+    import redisHelper as rh
+
+CHANNELTIMING = 'monitor:timing'
+
+
+class StageTimer():
+    """
+    Aggregates per-stage durations into histograms with logarithmically
+    spaced bins between 10 us and 10 s.
+    """
+
+    def __init__(self, enabled=True, nBins=60, tMin=1E-5, tMax=10.):
+        self.enabled = enabled
+        self.binEdges = np.logspace(np.log10(tMin), np.log10(tMax), nBins+1)
+        self.depth = 0
+        self.current = {}
+        self.last = {}
+        self.reset()
+
+    def reset(self):
+        self.hist = {}
+        self.total = {}
+        self.nCycles = {}
+        self.maxTime = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''Time the enclosed block and add it to the current cycle.'''
+        if not self.enabled:
+            yield
+            return
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t1)
+
+    @contextmanager
+    def cycle(self):
+        '''
+        Delimits one cycle. Cycles can be nested; the stage totals are
+        only pushed into the histograms when the outermost one exits.
+        '''
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.end_cycle()
+
+    def add(self, name, duration):
+        if not self.enabled:
+            return
+        self.current[name] = self.current.get(name, 0.) + duration
+
+    def end_cycle(self):
+        for name, duration in self.current.items():
+            if name not in self.hist:
+                self.hist[name] = np.zeros(len(self.binEdges)-1).astype(int)
+                self.total[name] = 0.
+                self.nCycles[name] = 0
+                self.maxTime[name] = 0.
+            idx = np.searchsorted(self.binEdges, duration) - 1
+            idx = min(max(idx, 0), len(self.hist[name])-1)
+            self.hist[name][idx] += 1
+            self.total[name] += duration
+            self.nCycles[name] += 1
+            self.maxTime[name] = max(self.maxTime[name], duration)
+        self.last = self.current
+        self.current = {}
+        return self.last
+
+    def quantile(self, name, q):
+        '''Approximate quantile of a stage duration from its histogram.'''
+        hist = self.hist[name]
+        cdf = np.cumsum(hist)
+        if cdf[-1] == 0:
+            return 0.
+        idx = np.searchsorted(cdf, q*cdf[-1])
+        return float(self.binEdges[idx+1])
+
+    def summary(self):
+        '''
+        Returns a dictionary with the last, mean, median, 95th percentile
+        and max duration of each stage in seconds.
+        '''
+        ret = {}
+        for name in self.hist:
+            n = self.nCycles[name]
+            ret[name] = {'n': n,
+                         'last': self.last.get(name, 0.),
+                         'mean': self.total[name]/n,
+                         'p50': self.quantile(name, 0.5),
+                         'p95': self.quantile(name, 0.95),
+                         'max': self.maxTime[name]}
+        return ret
+
+    def get_histograms(self):
+        return {'binEdges': self.binEdges.tolist(),
+                'hist': {k: v.tolist() for k, v in self.hist.items()}}
+
+    def publish(self, r, channel=CHANNELTIMING, max_len=100):
+        '''Send the last cycle and the running summary to a redis stream.'''
+        data = {'last': self.last, 'summary': self.summary()}
+        return rh.send_to_redis(r, channel, data, max_len=max_len)
@@ -17,11 +17,21 @@ try:
     import bellhelper.data.singletimetagger as tt
     import bellhelper.data.analysis_library as al
     import bellhelper.data.processBellData as pdbell
+    from bellhelper.data.fetchscheduler import FetchScheduler
+    from bellhelper.data.stagetimer import StageTimer, CHANNELTIMING
+    from bellhelper.data.rawbuffer import RawDataBuffer
+    from bellhelper.data.offsettracker import OffsetTracker
+    from bellhelper.data.phasetracker import PhaseHistogramAccumulator
 except Exception:
     import coinclib as cl
     import singletimetagger as tt
     import analysis_library as al
     import processBellData as pdbell
+    from fetchscheduler import FetchScheduler
+    from stagetimer import StageTimer, CHANNELTIMING
+    from rawbuffer import RawDataBuffer
+    from offsettracker import OffsetTracker
+    from phasetracker import PhaseHistogramAccumulator
 
 
 class TimeTaggers():
@@ -37,6 +47,14 @@ class TimeTaggers():
         self.config = config
         self.timeTaggers = {'alice': {'name': 'alice'}, 'bob': {'name': 'bob'}}
         self.configFile = configFile
+        self.scheduler = FetchScheduler()
+        self.stageTimer = StageTimer()
+        self.timingRedis = None
+        self.timingChannel = CHANNELTIMING
+        self.rawBuffer = RawDataBuffer()
+        self.offsetTracker = OffsetTracker()
+        self.phaseAccumulators = {'alice': {}, 'bob': {}}
+        self.nAnalyzed = 0
         self.simple_init()
 
     def simple_init(self):
@@ -83,6 +101,17 @@ class TimeTaggers():
     #         except Exception:
     #             pass
 
+    def set_timing_publisher(self, r, channel=CHANNELTIMING):
+        '''
+        Publish the stage timings to a redis stream after every update.
+        Pass r=None to stop publishing.
+        '''
+        self.timingRedis = r
+        self.timingChannel = channel
+
+    def get_timing_summary(self):
+        return self.stageTimer.summary()
+
     def reconnect(self):
         self.simple_init()
         # for key in ['alice','bob']:
@@ -142,12 +171,16 @@ class TimeTaggers():
         counts = ttagger.get_stats(dt)
         q.put(counts)
 
-    def get_data(self, ttager, dt, q=''):
-        # t1 = time.time()
+    def get_data(self, ttager, dt, q='', party=None):
+        t1 = time.time()
         data = ttager.stream_server(dt)
-        # print(data)
-        # t2 = time.time()
-        # print('Fetch took', t2-t1, 'ms, dt:',dt)
+        t2 = time.time()
+        if party is not None:
+            self.scheduler.record_latency(party, t2-t1)
+            timing = getattr(ttager, 'lastTiming', None)
+            if timing is not None:
+                for stage, duration in timing.items():
+                    self.stageTimer.add(stage+'_'+party, duration)
         q.put(data)
         return data
 
@@ -156,7 +189,7 @@ class TimeTaggers():
         t = {}
         for key in q:
             t[key] = threading.Thread(target=self.get_data, args=(
-                self.timeTaggers[key], intTime, q[key]))
+                self.timeTaggers[key], intTime, q[key], key))
 
         for key in q:
             t[key].start()
@@ -173,8 +206,41 @@ class TimeTaggers():
 
             # except Exception:
             #     rawData[key] = None
+        self.rawBuffer.add(rawData)
         return(rawData)
 
+    def get_calibration_data(self, intTime, useBuffer=False):
+        '''
+        Returns intTime seconds of raw data for the calibration routines,
+        freshly fetched from the timetaggers. With useBuffer=True it is
+        taken from the buffer of recently fetched data instead, when
+        enough of it is available.
+        '''
+        rawData = None
+        if useBuffer:
+            rawData = self.rawBuffer.get_data(intTime)
+        if rawData is None:
+            rawData = self.fetch_data(intTime)
+        return rawData
+
+    def get_phase_accumulators(self, detA, detB):
+        '''
+        Returns the decaying phase histogram accumulators for Alice's
+        detector detA and Bob's detector detB, creating them if needed.
+        '''
+        decay = self.config['analysis'].get('phaseHistDecay', 0.8)
+        accumulators = {}
+        for party, det in (('alice', detA), ('bob', detB)):
+            partyAccumulators = self.phaseAccumulators[party]
+            if det not in partyAccumulators:
+                partyAccumulators[det] = PhaseHistogramAccumulator(decay)
+            partyAccumulators[det].decay = decay
+            accumulators[party] = partyAccumulators[det]
+        return accumulators
+
+    def reset_phase_accumulators(self):
+        self.phaseAccumulators = {'alice': {}, 'bob': {}}
+
     def get_ch_settings(self):
         params = {'alice': {}, 'bob': {}}
         for key in params:
@@ -189,9 +255,9 @@ class TimeTaggers():
         params['findPk'] = self.config['analysis']['findPk']
         return(params)
 
-    def find_pc_turn_on_off(self, intTime):
+    def find_pc_turn_on_off(self, intTime, useBuffer=False):
 
-        rawData = self.fetch_data(intTime)
+        rawData = self.get_calibration_data(intTime, useBuffer=useBuffer)
         #rawData['bob'] = rawData['alice']
 
         # Next, with the data, trim it and find the offsets
@@ -225,10 +291,10 @@ class TimeTaggers():
         config_fp.close()
         return(pcSS)
 
-    def find_sync_offset2(self, intTime, rawData=None):
+    def find_sync_offset2(self, intTime, rawData=None, useBuffer=False):
 
         if rawData is None:
-            rawData = self.fetch_data(intTime)
+            rawData = self.get_calibration_data(intTime, useBuffer=useBuffer)
 
         # Next, with the data, trim it and find the offsets
         paramsCh = self.get_ch_settings()
@@ -254,6 +320,7 @@ class TimeTaggers():
         self.ttagOffset = ttagOffset
         self.offsetLaserPulse = offsetLaserPulse
         self.abDelay = abDelay
+        self.offsetTracker.reset(int(ttagOffset))
 
         self.config['analysis']['ttagOffset'] = int(ttagOffset)
         self.config['analysis']['pulseABDelay'] = int(offsetLaserPulse)
@@ -274,13 +341,28 @@ class TimeTaggers():
         # self.abDelay = self.config['analysis']['abDelay']
         # usePockelsMask = self.config['pockelProp']['enable']
 
-        margin = min(0.4*dt, 0.2)
-        margin = max(margin, 0.075)
+        # The margin and the wait before fetching adapt to the measured
+        # fetch latencies and how often recent updates failed to trim.
+        margin = self.scheduler.get_margin(dt)
         timeToFetch = dt + margin
-        time.sleep(dt)
-        rawData = self.fetch_data(timeToFetch)
-
-        counts, params = self.analyze_data(rawData, dt)
+        time.sleep(self.scheduler.get_sleep_time(dt))
+        with self.stageTimer.cycle():
+            self.scheduler.mark_fetch_start()
+            with self.stageTimer.stage('fetch'):
+                rawData = self.fetch_data(timeToFetch)
+
+            counts, params, reducedDataSet = self.analyze_data(rawData, dt)
+            self.scheduler.record_result(counts['isTrim'])
+        # Time from the end of the sample until update returns. Readers
+        # add rh.PUBLISHLATENCY for the publisher's own delay when telling
+        # which samples started after a move.
+        counts['publishLatency'] = margin + \
+            (time.time() - self.scheduler.lastFetchStart)
+        if self.timingRedis is not None:
+            try:
+                self.stageTimer.publish(self.timingRedis, self.timingChannel)
+            except Exception as e:
+                print('Could not publish the stage timing:', e)
         return(counts, params)
 
     def process_files(self, files, config):
@@ -328,20 +410,31 @@ class TimeTaggers():
         return chStatsAll
 
     def analyze_data(self, rawData, dt=None):
+        with self.stageTimer.cycle(), self.stageTimer.stage('analyze_data'):
+            return self._analyze_data(rawData, dt=dt)
+
+    def _analyze_data(self, rawData, dt=None):
+        timer = self.stageTimer
 
         self.ttagOffset = self.config['analysis']['ttagOffset']
         self.abDelay = self.config['analysis']['abDelay']
         self.syncTTagDiff = self.config['analysis']['syncTTagDiff']
         usePockelsMask = self.config['pockelProp']['enable']
 
+        # Opt-in: set analysis: trackOffset: true in the config
+        trackOffset = self.config['analysis'].get('trackOffset', False)
+
         paramsCh = self.get_ch_settings()
         divider = paramsCh['divider']*1.
         findPk = paramsCh['findPk']
         isTrim = True
+        self.nAnalyzed += 1
         # print(rawData)
 
-        trimmedData, err = cl.trim_data(
-            rawData, self.ttagOffset, self.abDelay, self.syncTTagDiff, paramsCh, dt=dt)
+        with timer.stage('trim_data'):
+            trimmedData, err = cl.trim_data(
+                rawData, self.ttagOffset, self.abDelay, self.syncTTagDiff,
+                paramsCh, dt=dt)
         isTrim = not err
 
         paramsSingle = copy.deepcopy(paramsCh)
@@ -349,6 +442,7 @@ class TimeTaggers():
         counts['isTrim'] = int(isTrim)
         params = {'alice': {}, 'bob': {}}
         reducedDataSet = {}
+        coincDiffs = []
         for detA in paramsCh['alice']['channels']['detector'].keys():
             for detB in paramsCh['bob']['channels']['detector'].keys():
                 detKey = detA + detB
@@ -357,9 +451,15 @@ class TimeTaggers():
                 paramsSingle['alice']['channels']['detector'] = detChA
                 paramsSingle['bob']['channels']['detector'] = detChB
 
+                accumulators = None
+                if findPk:
+                    accumulators = self.get_phase_accumulators(detA, detB)
                 try:
-                    results = cl.calc_data_properties(
-                        trimmedData, paramsSingle, divider, findPk=findPk)
+                    with timer.stage('calc_data_properties'):
+                        results = cl.calc_data_properties(
+                            trimmedData, paramsSingle, divider,
+                            findPk=findPk, accumulators=accumulators,
+                            tag=self.nAnalyzed)
                 except Exception:
                     print('failed data properties')
                     results = {}
@@ -373,19 +473,27 @@ class TimeTaggers():
                 pockelsMask, paramsPockels = self.get_pockels_mask(
                     trimmedData, results)
 
-                detMask = [detectionMask]
-                coincAndSingles = self.compute_coinc(
-                    trimmedData, results, detMask)
+                with timer.stage('compute_coinc'):
+                    detMask = [detectionMask]
+                    coincAndSingles = self.compute_coinc(
+                        trimmedData, results, detMask)
+
+                    maskPC = [detectionMask, pockelsMask]
+                    coincAndSinglesPC = self.compute_coinc(
+                        trimmedData, results, maskPC)
 
-                maskPC = [detectionMask, pockelsMask]
-                coincAndSinglesPC = self.compute_coinc(
-                    trimmedData, results, maskPC)
+                    maskDark = [detectionDarkMask]
+                    coincAndSinglesDark = self.compute_coinc(
+                        trimmedData, results, maskDark)
 
-                maskDark = [detectionDarkMask]
-                coincAndSinglesDark = self.compute_coinc(
-                    trimmedData, results, maskDark)
+                if trackOffset and isTrim:
+                    with timer.stage('track_offset'):
+                        coincDiffs.append(self.compute_coinc_diffs(
+                            trimmedData, results, detMask))
 
-                chStats, reducedData = self.compute_stats(trimmedData, results)
+                with timer.stage('compute_stats'):
+                    chStats, reducedData = self.compute_stats(
+                        trimmedData, results)
                 # if isTrim:
                 #     print(chStats, coincAndSingles)
                 reducedDataSet[detKey] = reducedData
@@ -408,6 +516,16 @@ class TimeTaggers():
                 else:
                     params['alice']['plotPA']['shadedRegion'] = None
                     params['bob']['plotPB']['shadedRegion'] = None
+        if trackOffset and isTrim and len(coincDiffs) > 0:
+            # Absorb slow clock drift between the timetaggers into the
+            # offset used for the next update.
+            # The tracker only changes the applied offset once its
+            # estimate has moved by a whole timetag bin.
+            ttagOffset = self.offsetTracker.update(
+                np.concatenate(coincDiffs), self.ttagOffset)
+            if ttagOffset != self.ttagOffset:
+                self.config['analysis']['ttagOffset'] = ttagOffset
+            counts['ttagOffsetTracker'] = self.offsetTracker.get_status()
         # print(paramsPockels)
         return(counts, params, reducedDataSet)
 
@@ -537,6 +655,18 @@ class TimeTaggers():
                   'coinc': coinc}
         return counts
 
+    def compute_coinc_diffs(self, data, props, masks):
+        '''
+        Returns the Alice - Bob timetag differences of the coincidences
+        found with the given masks.
+        '''
+        countsDataDict, laserPeriod = self.get_reduced_data(data, props, masks)
+        period = np.max(laserPeriod)
+        radius = (period-2)/2
+        diffs = cl.find_coincidence_diffs(countsDataDict['alice'],
+                                          countsDataDict['bob'], radius)
+        return diffs
+
     def get_reduced_data(self, data, props, masks):
         countsData = {}
         laserPeriod = []
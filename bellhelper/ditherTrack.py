@@ -0,0 +1,150 @@
+'''
+Continuous dither tracking for the mirror alignment. Instead of stopping
+for a full optimization, each axis in turn is stepped a small amount to
+either side of its current position. The normalized difference of the
+counts at the two points estimates the local gradient, and the axis is
+moved toward the optimum in proportion to how far the difference exceeds
+the Poisson noise of the coincidences. Differences within nSigma of the
+noise are ignored, so the mirrors don't random-walk around the peak.
+
+Dithers are square (+/-) rather than sinusoidal: each point needs the
+motors to settle and at least one full sample of the 0.2 s counts stream,
+so there is nothing to gain from intermediate positions.
+'''
+import threading
+import numpy as np
+
+try:
+    import bellhelper.read as read
+except Exception:
+    import read as read
+
+
+class DitherTracker():
+    """
+    mirror:    The MirrorControl to track with.
+    channels:  Motor channels to dither, one after another.
+    countType: Value of the counts to maximise ('SA', 'Coinc', 'SB',
+               'eff_a', 'eff_b' or 'effAB'), as in read.get_power.
+    amplitude: Dither amplitude in motor steps.
+    gain:      Servo step, in units of amplitude, per standard deviation
+               the measured difference exceeds nSigma by. Steps are
+               limited to one amplitude, which the default reaches at
+               nSigma + 4 standard deviations.
+    nSigma:    Differences below nSigma times their Poisson noise are
+               ignored.
+    intTime:   Integration time at each dither point.
+    maxDrift:  Largest distance, in motor steps, any channel may be moved
+               away from where tracking started.
+    """
+
+    def __init__(self, mirror, channels, countType='effAB', COUNTPATH='VV',
+                 amplitude=200, gain=0.25, nSigma=2., intTime=0.4,
+                 maxDrift=6000, pause=0.):
+        self.mirror = mirror
+        self.channels = [int(ch) for ch in channels]
+        self.countType = countType
+        self.COUNTPATH = COUNTPATH
+        self.amplitude = amplitude
+        self.gain = gain
+        self.nSigma = nSigma
+        self.intTime = intTime
+        self.maxDrift = maxDrift
+        self.pause = pause
+        self.startPos = None
+        self.center = {}
+        self.gradients = {ch: 0. for ch in self.channels}
+        self.nSteps = 0
+        self.lastValue = None
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def measure(self, channel, pos):
+        '''Moves channel to pos and returns (value, coincidences).'''
+        self.mirror.move_channels([channel], [pos])
+        settleTime = self.mirror.wait_for_settle([channel], [pos])
+        counts = read.get_counts(self.mirror.r, int_time=self.intTime,
+                                 count_path=self.COUNTPATH,
+                                 loop_args={'startTime': settleTime})
+        counts = counts[self.COUNTPATH]
+        return read.select_count_type(counts, self.countType), counts[1]
+
+    def step_axis(self, channel):
+        '''Dithers one channel, servoes it and returns the step taken.'''
+        center = self.center[channel]
+        vPlus, cPlus = self.measure(channel, center + self.amplitude)
+        vMinus, cMinus = self.measure(channel, center - self.amplitude)
+        self.lastValue = 0.5*(vPlus + vMinus)
+
+        step = 0
+        total = vPlus + vMinus
+        if total > 0:
+            d = (vPlus - vMinus)*1./total
+            self.gradients[channel] = d/(2.*self.amplitude)
+            # Poisson noise of the normalized difference
+            noise = 1./np.sqrt(max(cPlus + cMinus, 1))
+            excess = abs(d)/noise - self.nSigma
+            if excess > 0:
+                step = int(round(np.sign(d)*min(self.gain*excess, 1.) *
+                                 self.amplitude))
+        newCenter = center + step
+        drift = newCenter - self.startPos[channel]
+        if abs(drift) > self.maxDrift:
+            newCenter = self.startPos[channel] + \
+                np.sign(drift)*self.maxDrift
+        self.center[channel] = newCenter
+        self.mirror.move_channels([channel], [newCenter])
+        self.mirror.wait_for_settle([channel], [newCenter])
+        if step != 0:
+            self.nSteps += 1
+        return step
+
+    def run(self):
+        positions = self.mirror.positionCache.get_all(confirm=True)
+        self.startPos = {ch: positions[ch] for ch in self.channels}
+        self.center = dict(self.startPos)
+        try:
+            while not self.stopEvent.is_set():
+                for ch in self.channels:
+                    if self.stopEvent.is_set():
+                        break
+                    try:
+                        step = self.step_axis(ch)
+                    except Exception as e:
+                        print('Dither tracking error:', e)
+                        self.stopEvent.wait(1.)
+                        continue
+                    if step != 0:
+                        self.mirror.log_output(
+                            'Tracking ch %d: step %d to %d, %s %.3f' %
+                            (ch, step, self.center[ch], self.countType,
+                             self.lastValue))
+                if self.pause > 0:
+                    self.stopEvent.wait(self.pause)
+        finally:
+            # Leave every channel at its tracked center, not at a dither
+            # offset
+            self.mirror.move_channels(
+                self.channels, [self.center[ch] for ch in self.channels])
+            self.mirror.wait_for_settle(
+                self.channels, [self.center[ch] for ch in self.channels])
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def is_running(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def get_status(self):
+        return {'running': self.is_running(), 'center': dict(self.center),
+                'startPos': self.startPos, 'gradients': dict(self.gradients),
+                'nSteps': self.nSteps, 'value': self.lastValue}
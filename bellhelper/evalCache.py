@@ -0,0 +1,98 @@
+'''
+Memo layer for the alignment objective functions. Nelder-Mead and Powell
+often return to positions that, after rounding to the motor resolution,
+are the same physical position. A measurement taken there within the last
+ttl seconds is reused instead of paying for another move and integration,
+or, with combine=True, averaged with the new measurement to reduce its
+variance.
+'''
+import time
+import numpy as np
+
+
+class EvaluationCache():
+    """
+    quantum: Motor resolution used to quantise the positions, a scalar or
+             one value per axis.
+    ttl:     Seconds a measurement stays fresh.
+    combine: If True, positions are always re-measured and the result is
+             averaged with the fresh measurements already cached there.
+             If False, a fresh cached value is returned without measuring.
+    """
+
+    def __init__(self, quantum=1., ttl=30., combine=False):
+        self.quantum = quantum
+        self.ttl = ttl
+        self.combine = combine
+        self.entries = {}
+        self.nHits = 0
+        self.nMisses = 0
+        self.nCombined = 0
+
+    def get_key(self, pos):
+        q = np.asarray(pos, dtype=float)/np.asarray(self.quantum,
+                                                    dtype=float)
+        return tuple(np.round(q).astype(np.int64).tolist())
+
+    def _fresh(self, key):
+        now = time.time()
+        samples = [(t, val) for t, val in self.entries.get(key, [])
+                   if now - t <= self.ttl]
+        if len(samples) > 0:
+            self.entries[key] = samples
+        else:
+            self.entries.pop(key, None)
+        return samples
+
+    def lookup(self, pos):
+        '''The mean of the fresh measurements at pos, or None. A position
+        with fresh measurements counts as a hit. With combine=True None is
+        still returned, as the position is re-measured, and the hit is
+        also counted as combined.'''
+        samples = self._fresh(self.get_key(pos))
+        if len(samples) == 0:
+            self.nMisses += 1
+            return None
+        self.nHits += 1
+        if self.combine:
+            self.nCombined += 1
+            return None
+        return np.mean([val for t, val in samples])
+
+    def add(self, pos, value):
+        '''Stores a measurement at pos and returns the value to use: the
+        measurement itself, or with combine=True, its mean with the fresh
+        measurements cached at the same position.'''
+        key = self.get_key(pos)
+        samples = self._fresh(key) if self.combine else []
+        samples.append((time.time(), value))
+        self.entries[key] = samples
+        return np.mean([val for t, val in samples])
+
+    def evaluate(self, pos, measure):
+        '''Returns the cached value at pos if there is a fresh one,
+        otherwise measure() stored (and combined) at pos.'''
+        val = self.lookup(pos)
+        if val is not None:
+            return val
+        return self.add(pos, measure())
+
+    def hit_rate(self):
+        total = self.nHits + self.nMisses
+        if total == 0:
+            return 0.
+        return self.nHits*1./total
+
+    def summary(self):
+        msg = ('evaluation cache: %d hits, %d misses, hit rate %.1f%%' %
+               (self.nHits, self.nMisses, 100*self.hit_rate()))
+        if self.combine:
+            msg += ', %d measurements combined with earlier ones' % \
+                self.nCombined
+        return msg
+
+    def clear(self):
+        self.entries = {}
+        self.nHits = 0
+        self.nMisses = 0
+        self.nCombined = 0
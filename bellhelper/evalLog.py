@@ -0,0 +1,172 @@
+'''
+Telemetry of the optimizer objective evaluations and an offline replay
+harness.
+
+EvaluationRecorder writes one entry per objective evaluation (time,
+positions, measured value, integration time and the move, settle and
+integration latencies) to a redis stream in the compact binary encoding,
+and keeps them in memory. ReplayLandscape interpolates recorded
+evaluations into an objective that optimizer variants can be run against
+offline with replay_optimizer, to compare evaluations-to-converge without
+lab time.
+'''
+import time
+import numpy as np
+from scipy.optimize import minimize
+from scipy.interpolate import NearestNDInterpolator, LinearNDInterpolator
+
+try:
+    import bellhelper.redisHelper as rh
+    import bellhelper.surrogate as surrogate
+except Exception:
+    import redisHelper as rh
+    import surrogate as surrogate
+
+CHANNELEVALUATIONS = 'log:evaluations'
+
+
+class EvaluationRecorder():
+    """
+    r:        Redis connection (or config dict) to publish to, or None to
+              only keep the records in memory.
+    channel:  Stream to publish the evaluations to.
+    max_len:  Approximate length the stream is trimmed to.
+    keep:     Number of records kept in memory, None for all.
+    """
+
+    def __init__(self, r=None, channel=CHANNELEVALUATIONS, max_len=100000,
+                 keep=10000):
+        self.r = None if r is None else rh.get_redis(r)
+        self.channel = channel
+        self.max_len = max_len
+        self.keep = keep
+        self.records = []
+        self.run = None
+
+    def start_run(self, name):
+        '''Tags the following evaluations as one optimization run.'''
+        self.run = '%s:%d' % (name, int(1000*time.time()))
+        return self.run
+
+    def record(self, name, channels, positions, value, intTime=None,
+               timing={}, cached=False, **extra):
+        entry = {'t': time.time(), 'name': name, 'run': self.run,
+                 'channels': [str(ch) for ch in channels],
+                 'positions': np.asarray(positions, dtype=float),
+                 'value': float(value), 'cached': bool(cached)}
+        if intTime is not None:
+            entry['intTime'] = float(intTime)
+        for key, val in timing.items():
+            entry['t_' + key] = float(val)
+        entry.update(extra)
+        self.records.append(entry)
+        if (self.keep is not None) and (len(self.records) > self.keep):
+            self.records = self.records[-self.keep:]
+        if self.r is not None:
+            try:
+                rh.send_to_redis(self.r, self.channel, entry,
+                                 max_len=self.max_len, binary=True)
+            except Exception as e:
+                print('Could not publish the evaluation:', e)
+        return entry
+
+
+def load_evaluations(r, channel=CHANNELEVALUATIONS, t0=None, t1=None,
+                     name=None, run=None):
+    '''Reads recorded evaluations back from redis, optionally only those
+    of one optimizer name or run.'''
+    r = rh.get_redis(r)
+    records = [entry for timestamp, entry in rh.get_range(r, channel, t0, t1)]
+    if name is not None:
+        records = [rec for rec in records if rec.get('name') == name]
+    if run is not None:
+        records = [rec for rec in records if rec.get('run') == run]
+    return records
+
+
+class ReplayLandscape():
+    """
+    Objective built from recorded evaluations.
+    interpolation: 'nearest' returns the value of the closest recorded
+                   position, 'linear' interpolates between them (falling
+                   back to the nearest outside their hull).
+    noise:         None, or 'poisson' to draw each evaluation from a
+                   Poisson distribution around the interpolated counts.
+    """
+
+    def __init__(self, positions, values, interpolation='nearest',
+                 noise=None, seed=None):
+        self.positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        if self.positions.shape[0] == 1 and len(values) > 1:
+            self.positions = self.positions.T
+        self.values = np.asarray(values, dtype=float)
+        self.nearest = NearestNDInterpolator(self.positions, self.values)
+        self.linear = None
+        if (interpolation == 'linear') and \
+                (len(self.values) > self.positions.shape[1] + 1):
+            self.linear = LinearNDInterpolator(self.positions, self.values)
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.nfev = 0
+
+    @classmethod
+    def from_records(cls, records, channels=None, **kwargs):
+        '''Landscape of the records that moved the given channels (those of
+        the first record if None). Cached evaluations are skipped.'''
+        if channels is None:
+            channels = records[0]['channels']
+        channels = [str(ch) for ch in channels]
+        recs = [rec for rec in records
+                if list(rec['channels']) == channels and
+                not rec.get('cached', False)]
+        positions = [rec['positions'] for rec in recs]
+        values = [rec['value'] for rec in recs]
+        return cls(positions, values, **kwargs)
+
+    def __call__(self, pos):
+        self.nfev += 1
+        pos = np.atleast_2d(np.asarray(pos, dtype=float))
+        val = np.nan
+        if self.linear is not None:
+            val = float(self.linear(pos)[0])
+        if np.isnan(val):
+            val = float(self.nearest(pos)[0])
+        if self.noise == 'poisson':
+            val = float(self.rng.poisson(max(val, 0.)))
+        return val
+
+
+def replay_optimizer(landscape, start, scale=1., method='Nelder-Mead',
+                     options=None, maximize=True, target=None):
+    '''
+    Runs an optimizer against a recorded landscape the way the lab
+    optimizers do: x is a relative move from start in units of scale.
+    maximize: If True the objective is 1/(value + 1), as in
+              MirrorControl.obj_func, otherwise value is minimised, as in
+              optimize_wvplt_scipy.
+    target:   Value counted as converged. Defaults to the best value the
+              optimizer found.
+    Returns a dictionary with the result, the trajectory and the number
+    of evaluations needed to reach target.
+    '''
+    start = np.asarray(start, dtype=float)
+    values = []
+
+    def fun(x):
+        val = landscape(start + np.asarray(x)*scale)
+        values.append(val)
+        if maximize:
+            return 1./(val + 1.)
+        return val
+
+    res = minimize(fun, np.zeros_like(start),
+                   method=surrogate.resolve_method(method), options=options)
+    values = np.array(values)
+    best = np.max(values) if maximize else np.min(values)
+    if target is None:
+        target = best
+    reached = values >= target if maximize else values <= target
+    nToTarget = int(np.argmax(reached)) + 1 if np.any(reached) else None
+    return {'x': start + np.asarray(res.x)*scale, 'best': best,
+            'nfev': len(values), 'nToTarget': nToTarget,
+            'values': values, 'result': res}
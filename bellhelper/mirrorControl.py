@@ -10,7 +10,11 @@ import numpy as np
 from scipy.optimize import minimize
 # from scipy.optimize import basinhopping
 # from scipy import optimize
-from bellMotors.motorControlZaber import MotorControllerZaber
+try:
+    from bellMotors.motorControlZaber import MotorControllerZaber
+except ImportError:
+    # Only the simulated controllers (bellhelper.sim) can be used
+    MotorControllerZaber = None
 # from bellhelper.dailylogs import MyTimedRotatingFileHandler
 # import bellhelper.read as read
 import logging
@@ -21,11 +25,23 @@ try:
     # from bellMotors.motorControlZaber import MotorControllerZaber
     from bellhelper.dailylogs import MyTimedRotatingFileHandler
     import bellhelper.read as read
+    import bellhelper.settle as settle
+    from bellhelper.parallelMove import ParallelMover
+    from bellhelper.positionCache import PositionCache
+    import bellhelper.surrogate as surrogate
+    from bellhelper.evalCache import EvaluationCache
+    from bellhelper.ditherTrack import DitherTracker
 except Exception:
     import redisHelper as rh
     # from motorControlZaber import MotorControllerZaber
     from dailylogs import MyTimedRotatingFileHandler
     import read as read
+    import settle as settle
+    from parallelMove import ParallelMover
+    from positionCache import PositionCache
+    import surrogate as surrogate
+    from evalCache import EvaluationCache
+    from ditherTrack import DitherTracker
 # import bellhelper.redisHelper as rh
 
 # Writing a new class that inherits from the TimedRotatingFileHandler
@@ -37,9 +53,12 @@ except Exception:
 
 
 class MirrorControl():
-    def __init__(self, r, ip='127.0.0.1', port=55000, name='default', redisChannel='log:motoralign'):
+    def __init__(self, r, ip='127.0.0.1', port=55000, name='default', redisChannel='log:motoralign',
+                 controllerClass=None):
         # print('autoalign', ip, port, name)
-        self.r = r
+        # r may be a redis connection or a redis config dict, in which
+        # case the process-wide connection pool is used.
+        self.r = rh.get_redis(r)
         self.redisChannel = redisChannel
         fnLog = name + "zaber_motor"
         fn = os.path.join('motor_logs', fnLog)
@@ -49,12 +68,31 @@ class MirrorControl():
         # print(dtnow)
         self.ip = ip
         self.port = port
-        self.zb = MotorControllerZaber(ip, port=port)
+        # controllerClass replaces MotorControllerZaber, e.g. with
+        # sim.SimZaberController
+        if controllerClass is None:
+            controllerClass = MotorControllerZaber
+        self.zb = controllerClass(ip, port=port)
+        # Per-channel connections for moving several channels at once
+        self.mover = ParallelMover(
+            lambda: controllerClass(self.ip, port=self.port))
         self.intTime = 1
+        # Passed to settle.wait_for_settle after each move. Zaber moves
+        # land on the target microstep.
+        self.settleArgs = {'target_tol': 1, 'poll_time': 0.05,
+                           'timeOut': 10.}
+        # Measurements at the same microstep positions within evalTTL
+        # seconds are reused (or averaged, with evalCombine) by obj_func
+        self.evalTTL = 30.
+        self.evalCombine = False
+        self.evalCache = EvaluationCache(quantum=1., ttl=self.evalTTL,
+                                         combine=self.evalCombine)
         # Disable the Potentiometer knobs
         self.zb.potentiometer_all_enabled(False)
         # print('Set potentiometer')
         self.channels = self.zb.channels
+        # Positions by int(channel), updated from the commanded moves
+        self.positionCache = PositionCache(self.read_all_positions)
         self.motor_info = {}
         self.extract_channel_path_names()
         self.BESTCOUNTS = 0
@@ -63,6 +101,9 @@ class MirrorControl():
         # print(self.BESTPOS)
         self.name = name
         self.CONFIGKEY = 'config:timetaggers'
+        self.tracker = None
+        # Optional evalLog.EvaluationRecorder for every obj_func call
+        self.recorder = None
         # logger.info("BESTPOS:" + str(self.BESTPOS))
 
     # def setup_logger(self, name, log_file, level=logging.INFO):
@@ -137,19 +178,52 @@ class MirrorControl():
         self.motor_info = motor_info
 
     def move_all_to_position(self, pos):
+        self.check_not_tracking()
         for i in range(len(self.channels)):
             self.zb.move_absolute(self.channels[i], pos[i])
+        self.positionCache.set_commanded(
+            {int(self.channels[i]): pos[i] for i in range(len(self.channels))})
 
     def move_all_relative(self, pos):
         for i in range(len(self.channels)):
             self.zb.move_relative(self.channels[i], pos[i])
-
-    def get_all_positions(self):
-        pos = [-1] * len(self.channels)
-        for i in range(len(self.channels)):
-            # print(i, pos)
-            pos[i] = self.zb.get_position(self.channels[i])
-        return pos
+        self.positionCache.invalidate()
+
+    def read_all_positions(self):
+        '''Reads every channel position back from the motors in one
+        parallel round trip. Returns {int(channel): position}.'''
+        pos = self.mover.query(self.channels, method='get_position')
+        return {int(ch): p for ch, p in pos.items()}
+
+    def get_all_positions(self, confirm=False):
+        '''Positions of all channels, from the position cache unless it
+        is stale or confirm is True and a move is still unconfirmed.'''
+        pos = self.positionCache.get_all(confirm=confirm)
+        return [pos[int(ch)] for ch in self.channels]
+
+    def move_channels(self, channels, pos):
+        '''Moves the given channels to the absolute positions pos in
+        parallel and returns once all the moves were issued.'''
+        moves = {channels[i]: pos[i] for i in range(len(channels))}
+        self.mover.move(moves, method='move_absolute')
+        self.positionCache.set_commanded(
+            {int(ch): p for ch, p in moves.items()})
+
+    def wait_for_settle(self, channels, targets=None):
+        '''Waits until the given channels stop moving and returns the time
+        they settled.'''
+        last = {}
+
+        def get_positions():
+            last.update(self.mover.query(channels, method='get_position'))
+            return [last[ch] for ch in channels]
+        settleTime = settle.wait_for_settle(
+            get_positions, targets=targets,
+            clock=lambda: rh.server_time(self.r), **self.settleArgs)
+        # The last poll doubles as the readback of the moved channels
+        self.positionCache.set_confirmed(
+            {int(ch): p for ch, p in last.items()})
+        return settleTime
 
     def check_bounds(self, pos, startP):
         L = 6000 * 3
@@ -167,6 +241,7 @@ class MirrorControl():
         return True
 
     def obj_func(self, pos, params):
+        self.check_not_tracking()
         channels = params['channels']
         countType = params['countType']
         COUNTPATH = params['countpath']
@@ -186,17 +261,37 @@ class MirrorControl():
         if (not inBounds):
             val = 1E12
             return val
-        for i in range(len(channels)):
-            self.zb.move_absolute(channels[i], pos[i])
-        # time.sleep(self.intTime)
-        time.sleep(1.2)
-        # time.sleep(.6)
-        #######################
-        counts = read.get_power(self.r, self.intTime,
-                                countType, COUNTPATH)
+        # Every channel's position at this evaluation
+        allPos = self.positionCache.get_all()
+        allPos.update({int(channels[i]): pos[i]
+                       for i in range(len(channels))})
+        allPos = [allPos[int(ch)] for ch in self.channels]
+
+        timing = {}
+
+        def measure():
+            t0 = time.time()
+            self.move_channels(channels, pos)
+            t1 = time.time()
+            # Only count samples taken after the mirrors stopped moving
+            settleTime = self.wait_for_settle(channels, pos)
+            t2 = time.time()
+            #######################
+            counts = read.get_power(self.r, self.intTime,
+                                    countType, COUNTPATH,
+                                    loop_args={'startTime': settleTime})
+            timing.update({'move': t1 - t0, 'settle': t2 - t1,
+                           'integrate': time.time() - t2})
+            return counts
+        counts = self.evalCache.evaluate(allPos, measure)
+        if self.recorder is not None:
+            self.recorder.record(self.name, channels, pos, counts,
+                                 intTime=self.intTime, timing=timing,
+                                 cached=(len(timing) == 0),
+                                 countType=countType)
 
         if (counts > self.BESTCOUNTS):
-            self.BESTPOS = self.get_all_positions()
+            self.BESTPOS = allPos
             self.BESTCOUNTS = counts
 
         val = 1./(counts*1. + 1.)
@@ -217,12 +312,66 @@ class MirrorControl():
             rh.send_to_redis(self.r, self.redisChannel, msgDict, max_len=100)
         # print(msg)
 
+    def start_tracking(self, path, countType='effAB', dir='xy',
+                       COUNTPATH='VV', **trackerArgs):
+        '''
+        Starts continuous dither tracking of the channels of path in the
+        background (see ditherTrack.py). dir selects the 'x', 'y' or both
+        ('xy') channels. optimize_eff and the other moves raise an
+        exception while tracking runs.
+        '''
+        if self.is_tracking():
+            raise Exception('Already tracking, call stop_tracking first')
+        if path.lower() == 'both':
+            paths = list(self.motor_info.keys())
+        else:
+            paths = [path]
+        channels = []
+        for p in paths:
+            for d in ('y', 'x'):
+                if d in dir:
+                    channels += self.motor_info[p][d]['ch']
+        self.tracker = DitherTracker(self, channels, countType=countType,
+                                     COUNTPATH=COUNTPATH, **trackerArgs)
+        self.tracker.start()
+        return self.tracker
+
+    def is_tracking(self):
+        return (self.tracker is not None) and self.tracker.is_running()
+
+    def check_not_tracking(self):
+        '''The tracker moves the channels through the same mover and
+        position cache, so nothing else may move them while it runs.'''
+        if self.is_tracking():
+            raise Exception('Dither tracking is running, '
+                            'call stop_tracking first')
+
+    def stop_tracking(self):
+        '''Stops dither tracking and returns its final status.'''
+        if self.tracker is None:
+            return None
+        self.tracker.stop()
+        status = self.tracker.get_status()
+        self.log_output('Stopped tracking: ' + str(status['center']))
+        return status
+
     def optimize_eff(self, path, countType='effAB', dir='xy',
-                     COUNTPATH='VV', q=None):
+                     COUNTPATH='VV', q=None, method='Nelder-Mead'):
+        '''
+        method: 'Nelder-Mead' or any other scipy.optimize.minimize method,
+                or 'surrogate' to fit a Gaussian model of the counts to
+                the measurements and move to its peak (see surrogate.py),
+                which typically needs far fewer measurements.
+        '''
         # global STARTPOS, BESTPOS, BESTCOUNTS, COUNTTYPE, channels, pathVChanX, pathVChanY, pathHChanX, pathHChanY
+        self.check_not_tracking()
         self.COUNTTYPE = countType
         self.BESTCOUNTS = 0.
-        self.STARTPOS = self.get_all_positions()
+        self.STARTPOS = self.get_all_positions(confirm=True)
+        if self.recorder is not None:
+            self.recorder.start_run(self.name)
+        self.evalCache = EvaluationCache(quantum=1., ttl=self.evalTTL,
+                                         combine=self.evalCombine)
         self.log_output("Starting Position: " + str(self.STARTPOS), q)
         # self.log_output("", q)
         xChan = []
@@ -249,6 +398,9 @@ class MirrorControl():
         params = {'countType': countType, 'scale': SCALE,
                   'q': q, 'countpath': COUNTPATH}
         options = {'ftol': 1.2e-3, 'maxfev': 40}
+        if method == 'surrogate':
+            options = {'maxfev': 25, 'model': 'gaussian'}
+        method = surrogate.resolve_method(method)
 
         # minimizer_kwargs = {"method": "Nelder-Mead", "args": (params), "options": options}
         # niter = 10
@@ -263,13 +415,13 @@ class MirrorControl():
         if (dir == 'y' or dir == 'xy' or dir == 'y single'
                 or dir == 'xy single'):
             self.move_all_to_position(self.STARTPOS)
-            time.sleep(3)
+            self.wait_for_settle(self.channels, self.STARTPOS)
             params['channels'] = yChan
             params['scale'] = params['scale'] * 4.
             # self.log_output("Starting Y alignment, Path: " + path, q)
             # self.log_output("Current, Best", q)
             resy = minimize(self.obj_func, x0, params,
-                            method='Nelder-Mead', options=options)
+                            method=method, options=options)
             # resy = minimize(self.obj_func, x0, params, method = 'CG', options = optionsCG)
             # resy = basinhopping(self.obj_func, x0, minimizer_kwargs = minimizer_kwargs, stepsize = stepsize )
             self.STARTPOS = self.BESTPOS
@@ -282,14 +434,14 @@ class MirrorControl():
         if (dir == 'x' or dir == 'xy' or dir == 'x single'
                 or dir == 'xy single'):
             self.move_all_to_position(self.STARTPOS)
-            time.sleep(3)
+            self.wait_for_settle(self.channels, self.STARTPOS)
             params['channels'] = xChan
             params['scale'] = params['scale']*1./3.
             # self.log_output("Starting X alignment, Path: " + path, q)
             # self.log_output("Current, Best", q)
             # resx = minimize(self.obj_func, x0,params, method = 'Nelder-Mead', options = options)
             resx = minimize(self.obj_func, x0, params,
-                            method='Nelder-Mead', options=options)
+                            method=method, options=options)
             # resx = basinhopping(optimize_x, x0, minimizer_kwargs = minimizer_kwargs, niter = niter, stepsize = stepsize)
             self.STARTPOS = self.BESTPOS
             # self.STARTPOS = self.get_all_positions()
@@ -298,6 +450,7 @@ class MirrorControl():
             # self.log_output("", q)
             self.BESTCOUNTS = 0.
 
+        self.log_output(self.evalCache.summary(), q)
         self.move_all_to_position(self.BESTPOS)
         # Set the integration time back to it's original value
         # read.set_integration_time(self.r, oldIntTime, self.CONFIGKEY)
@@ -0,0 +1,88 @@
+'''
+Concurrent multi-axis moves. The motor controller connections block for
+the duration of a move and are not shared between threads, so each axis
+gets its own connection, opened on first use and kept for later moves,
+and the moves of one call are issued from a thread pool and waited on
+together.
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ParallelMover():
+    """
+    make_controller: Function returning a new motor controller connection,
+                     e.g. lambda: MotorController(ip, port=port).
+    max_workers:     Largest number of moves run at the same time.
+    """
+
+    def __init__(self, make_controller, max_workers=8):
+        self.make_controller = make_controller
+        self.max_workers = max_workers
+        self.controllers = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def get_controller(self, axis):
+        with self.lock:
+            controller = self.controllers.get(axis)
+            if controller is None:
+                controller = self.make_controller()
+                self.controllers[axis] = controller
+        return controller
+
+    def _get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+        return self.executor
+
+    def _move_one(self, axis, pos, method):
+        controller = self.get_controller(axis)
+        return getattr(controller, method)(axis, pos)
+
+    def move(self, moves, method='goto'):
+        '''
+        Moves every axis in the dictionary moves {axis: position} at the
+        same time by calling controller.method(axis, position) on each
+        axis' connection, and returns once all of them have finished.
+        Returns {axis: return value}. If any move fails, the first error
+        is raised after the others have finished.
+        '''
+        if len(moves) == 1:
+            axis, pos = list(moves.items())[0]
+            return {axis: self._move_one(axis, pos, method)}
+        executor = self._get_executor()
+        futures = {axis: executor.submit(self._move_one, axis, pos, method)
+                   for axis, pos in moves.items()}
+        results = {}
+        error = None
+        for axis, future in futures.items():
+            try:
+                results[axis] = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def query(self, axes, method='getPos'):
+        '''
+        Calls controller.method(axis) for every axis at the same time and
+        returns {axis: return value}, e.g. to read back all positions in
+        one round trip.
+        '''
+        executor = self._get_executor()
+        futures = {axis: executor.submit(
+            lambda a: getattr(self.get_controller(a), method)(a), axis)
+            for axis in axes}
+        return {axis: future.result() for axis, future in futures.items()}
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            self.controllers = {}
@@ -1,8 +1,18 @@
 #!/usr/bin/env python
 # coding: utf-8
 import numpy as np
-from bellMotors.motorControl import MotorController
+try:
+    from bellMotors.motorControl import MotorController
+except ImportError:
+    # Only the simulated controllers (bellhelper.sim) can be used
+    MotorController = None
 import bellhelper.read as read
+import bellhelper.redisHelper as rh
+import bellhelper.settle as settle
+from bellhelper.parallelMove import ParallelMover
+from bellhelper.positionCache import PositionCache
+import bellhelper.surrogate as surrogate
+from bellhelper.evalCache import EvaluationCache
 import bellhelper as bh
 import logging
 from bellhelper.dailylogs import MyTimedRotatingFileHandler
@@ -13,7 +23,6 @@ import os.path
 import os
 import json
 from functools import wraps
-import threading
 
 # Writing a new class that inherits from the TimedRotatingFileHandler
 # to implement a header for every new log file. Modification of  an
@@ -41,29 +50,44 @@ class PolControl():
     """Class to connect to various bridge and source motors
     and move them while logging their positions.
     init args:
-          r - redis database/ redis connection.
+          r - redis database/ redis connection, or a redis config
+              dict to use the process-wide connection pool.
           ip - ip of the motorserveer
           port - port for the motorserver
           name - optional name for the pol control object
+          controller_class - replaces MotorController, e.g. with
+                             sim.SimMotorController
     """
 
     def __init__(self, r=None, ip='127.0.0.1', port=55000,
-                 name='default', log_stuff=False):
+                 name='default', log_stuff=False, controller_class=None):
         # length of the undo and redo stack that allows for
         # simple undo and redo operations
         self.UNDO_STACK_MAX = 20
-        self.r = r
+        self.r = rh.get_redis(r)
 
         self.name = name
         self.ip = ip
         self.port = port
-        self.mc = MotorController(ip, port=port)
+        if controller_class is None:
+            controller_class = MotorController
+        self.mc = controller_class(ip, port=port)
+        # Per-waveplate connections, kept for moving several at once
+        self.mover = ParallelMover(
+            lambda: controller_class(self.ip, port=self.port))
+        # Motor positions, updated from the commanded moves and read back
+        # with a single getAllPos only when needed
+        self.positions = PositionCache(self.mc.getAllPos)
         self.undo_stack = []
         self.redo_stack = []
         self.add_to_stack(self.update_positions(), 'undo')
         self.motor_zeros = {}
         self.init_zeros()
         self.log_stuff = log_stuff
+        # Passed to settle.wait_for_settle after each optimizer move
+        self.settle_args = {'tol': 0.01, 'poll_time': 0.05, 'timeOut': 10.}
+        # Optional evalLog.EvaluationRecorder for every optimizer evaluation
+        self.recorder = None
         self.set_motor_information()
         if self.log_stuff:
             fnLog = name + "_polarization_motors"
@@ -76,7 +100,9 @@ class PolControl():
             self.motor_zeros[key] = 0
 
     def set_redis(self, redis_db):
-        self.r = redis_db
+        '''redis_db can be a redis connection or a redis config dict,
+        in which case the process-wide connection pool is used.'''
+        self.r = rh.get_redis(redis_db)
 
     def set_motor_information(self):
         motor_info = {}
@@ -91,10 +117,12 @@ class PolControl():
         self.motor_info = motor_info
         return
 
-    def update_positions(self):
+    def update_positions(self, confirm=False):
         '''returns the updated motor positions dict and
-        updates the motor_list class variable'''
-        self.motor_list = self.mc.getAllPos()
+        updates the motor_list class variable. The positions come from
+        the position cache unless confirm is True and a commanded move
+        has not been read back yet.'''
+        self.motor_list = self.positions.get_all(confirm=confirm)
         return self.motor_list
 
     def add_to_stack(self, positions, name):
@@ -138,14 +166,18 @@ class PolControl():
         @wraps(func)
         def wrapper(self, *args, **kwargs):
             if self.log_stuff:
-                start_pos = json.dumps(self.mc.getAllPos())
+                # Read the start positions fresh, as the motors may have
+                # been moved by another client since the last readback
+                self.positions.invalidate()
+                start_pos = json.dumps(self.update_positions())
                 ret = func(self, *args, **kwargs)
-                end_pos = json.dumps(self.mc.getAllPos())
+                # A single readback confirms where the moves ended up
+                end_pos = json.dumps(self.update_positions(confirm=True))
                 self.logger.info("start positions : " + start_pos)
                 self.logger.info("moved to : " + end_pos)
                 self.logger.info("function used was : " + func.__name__
                                  + '\n\n\n')
-                self.add_to_stack(self.update_positions(), 'undo')
+                self.add_to_stack(self.motor_list, 'undo')
                 return ret
             else:
                 # dont log, simply run the function
@@ -216,34 +248,49 @@ class PolControl():
         return move_wps
 
     def _move_motor_absolute(self, pos, motor):
-        self.update_positions()
-        self.mc.goto(motor, pos + self.motor_zeros[motor])
+        target = float(pos + self.motor_zeros[motor])
+        self.mc.goto(motor, target)
+        self.positions.set_commanded({motor: target})
         self.update_positions()
         return
 
     def _move_motor_relative(self, delta, motor):
-        self.update_positions()
         self.mc.forward(motor, delta)
+        self.positions.invalidate()
         self.update_positions()
         return
 
+    def wait_for_settle(self, waveplates, mc_obj=None):
+        '''Waits until the waveplates stop moving and returns the time
+        they settled.'''
+        if mc_obj is None:
+            mc_obj = self.mc
+
+        last = {}
+
+        def get_positions():
+            last.update({wp: float(mc_obj.getPos(wp)) for wp in waveplates})
+            return [last[wp] for wp in waveplates]
+        settle_time = settle.wait_for_settle(
+            get_positions, clock=lambda: rh.server_time(self.r),
+            **self.settle_args)
+        # The last poll doubles as the readback of the moved waveplates
+        self.positions.set_confirmed(last)
+        return settle_time
+
     def thread_set(self, ang_dict):
-        t = []
-        mc = []
-        for wp in ang_dict:
-            ang = ang_dict[wp]
-            # print(wp)
-            mc.append(MotorController(self.ip, port=self.port))
-            t.append(threading.Thread(target=mc[-1].goto, args=(wp, ang,)))
-            t[-1].start()
-        for th in t:
-            th.join()
+        '''moves every waveplate in ang_dict {waveplate: angle} at the
+        same time and returns once all have arrived'''
+        self.mover.move(ang_dict, method='goto')
+        self.positions.set_commanded({wp: float(ang_dict[wp])
+                                      for wp in ang_dict})
         return
 
     @_logging_wrapper
     def homeAll(self):
         for key in self.motor_info:
             self.mc.home(key)
+        self.positions.invalidate()
         return
 
     @_logging_wrapper
@@ -285,6 +332,9 @@ class PolControl():
         for key in motor_pos:
             self.mc.goto(key, motor_pos[key] +
                          self.motor_zeros[key])
+        self.positions.set_commanded(
+            {key: float(motor_pos[key] + self.motor_zeros[key])
+             for key in motor_pos})
         return 0
 
     @_logging_wrapper
@@ -292,7 +342,19 @@ class PolControl():
                              count_type='Coinc',
                              int_time=1,
                              window_type='VV',
-                             method='Powell'):
+                             method='Powell',
+                             eval_quantum=0.01,
+                             eval_ttl=30.,
+                             eval_combine=False):
+        '''
+        method: any scipy.optimize.minimize method, or 'surrogate' (see
+                surrogate.py).
+        eval_quantum, eval_ttl, eval_combine: waveplate positions that
+                agree to within eval_quantum reuse a measurement taken
+                less than eval_ttl seconds ago instead of moving and
+                integrating again, or average with it if eval_combine
+                (see evalCache.py).
+        '''
 
         def waveplate_optimization_function(pos, params):
             mc_obj = params['mc_obj']
@@ -310,19 +372,33 @@ class PolControl():
             # print(pos, startPos, SCALE, "Channels:", channels)
             pos = pos * scale + start_pos
 
-            for i, waveplate in enumerate(waveplates):
-                mc_obj.goto(waveplate, pos[i])
-            # move_all_to_position(pos.tolist())
-            time.sleep(.5)
-            counts = read.get_power(self.r, int_time,
-                                    count_type, window_type)
+            timing = {}
+
+            def measure():
+                t0 = time.time()
+                self.thread_set({waveplate: pos[i]
+                                 for i, waveplate in enumerate(waveplates)})
+                # move_all_to_position(pos.tolist())
+                t1 = time.time()
+                # Only count samples taken after the waveplates stopped
+                settle_time = self.wait_for_settle(waveplates, mc_obj)
+                t2 = time.time()
+                counts = read.get_power(self.r, int_time,
+                                        count_type, window_type,
+                                        loop_args={'startTime': settle_time})
+                timing.update({'move': t1 - t0, 'settle': t2 - t1,
+                               'integrate': time.time() - t2})
+                return counts
+            counts = params['eval_cache'].evaluate(pos, measure)
+            if self.recorder is not None:
+                self.recorder.record(self.name, waveplates, pos, counts,
+                                     intTime=int_time, timing=timing,
+                                     cached=(len(timing) == 0),
+                                     countType=count_type)
             # print(counts)
             # counts = counts[countIndxToOptimize]
             if (counts < best_counts):
-                best_pos = []
-                for waveplate in waveplates:
-                    best_pos.append(float(mc_obj.getPos(waveplate)))
-                params['best_pos'] = np.array(best_pos)
+                params['best_pos'] = np.array(pos, dtype=float)
                 params['best_counts'] = counts
             # self.log_output(counts, params['best_counts'])
             return counts
@@ -335,9 +411,12 @@ class PolControl():
             "\n The list of waveplates to be optimized is: ",
             move_wps)
         best_counts = np.inf
+        if self.recorder is not None:
+            self.recorder.start_run(self.name)
+        positions = self.update_positions(confirm=True)
         start_pos = []
         for waveplate in move_wps:
-            start_pos.append(float(self.mc.getPos(waveplate)))
+            start_pos.append(float(positions[waveplate]))
 
         scale = 1  # Amount to scale the step size by
         self.log_output("\n Starting optimization at : ", start_pos,
@@ -350,8 +429,16 @@ class PolControl():
                   'mc_obj': self.mc,
                   'waveplate': move_wps,
                   'int_time': int_time,
-                  'window_type': window_type}
+                  'window_type': window_type,
+                  'eval_cache': EvaluationCache(quantum=eval_quantum,
+                                                ttl=eval_ttl,
+                                                combine=eval_combine)}
         options = {'xtol': 0.2}
+        if method == 'surrogate':
+            # Quadratic model of the counts around the minimum, with
+            # 2 degree initial steps
+            options = {'xtol': 0.2, 'initial_step': 2., 'maxfev': 30}
+        method = surrogate.resolve_method(method)
         # minimizer_kwargs = {"method": "Nelder-Mead",
         # "args": (params), "options": options}
         # niter = 20
@@ -368,6 +455,7 @@ class PolControl():
         self.log_output("\n Finished optimization at: ",
                         params['best_pos'], 'with counts:',
                         params['best_counts'], '\n')
+        self.log_output(params['eval_cache'].summary())
         for i, waveplate in enumerate(move_wps):
             self._move_motor_absolute(params['best_pos'][i],
                                       waveplate)
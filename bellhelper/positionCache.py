@@ -0,0 +1,83 @@
+'''
+Cache of motor positions. Positions are updated from the commanded
+absolute moves and only read back from the motor server, in one batched
+call, when the cache has been invalidated (e.g. by a relative move or
+homing), is older than maxAge, or a confirmed value is asked for. The age
+is kept per axis, so positions read back by other means (e.g. the polls
+while waiting for a move to settle) count as fresh.
+'''
+import time
+
+
+class PositionCache():
+    """
+    readback: Function returning the positions of all axes as a dictionary
+              {axis: position} in a single call.
+    maxAge:   Seconds after an axis was last read back before the cache
+              is read back again, which picks up moves made by other
+              clients or by hand. None to rely on the commanded moves
+              indefinitely.
+    """
+
+    def __init__(self, readback, maxAge=5.):
+        self.readback = readback
+        self.maxAge = maxAge
+        self.positions = {}
+        self.unconfirmed = set()
+        self.valid = False
+        # Time each axis was last read back
+        self.tConfirmed = {}
+        self.nReadbacks = 0
+        self.nHits = 0
+
+    def refresh(self):
+        '''Reads every position back from the motor server.'''
+        self.positions = dict(self.readback())
+        self.unconfirmed = set()
+        self.valid = True
+        now = time.time()
+        self.tConfirmed = {axis: now for axis in self.positions}
+        self.nReadbacks += 1
+        return dict(self.positions)
+
+    def is_stale(self):
+        if not self.valid:
+            return True
+        if self.maxAge is None:
+            return False
+        now = time.time()
+        return any((now - self.tConfirmed.get(axis, 0.)) > self.maxAge
+                   for axis in self.positions)
+
+    def get_all(self, confirm=False):
+        '''Returns {axis: position}, reading back only if the cache is
+        stale, or if confirm is True and a commanded move has not been
+        confirmed yet.'''
+        if self.is_stale() or (confirm and len(self.unconfirmed) > 0):
+            return self.refresh()
+        self.nHits += 1
+        return dict(self.positions)
+
+    def get(self, axis, confirm=False):
+        return self.get_all(confirm=confirm)[axis]
+
+    def set_commanded(self, moves):
+        '''Records the targets {axis: position} of absolute moves.'''
+        self.positions.update(moves)
+        self.unconfirmed.update(moves.keys())
+
+    def set_confirmed(self, positions):
+        '''Records positions {axis: position} that were read back by other
+        means, e.g. while waiting for the motors to settle.'''
+        self.positions.update(positions)
+        self.unconfirmed.difference_update(positions.keys())
+        now = time.time()
+        self.tConfirmed.update({axis: now for axis in positions})
+
+    def invalidate(self):
+        '''Forces a readback on the next access, e.g. after relative moves
+        or homing, where the final position is not known.'''
+        self.valid = False
+
+    def get_stats(self):
+        return {'readbacks': self.nReadbacks, 'hits': self.nHits}
@@ -1,9 +1,13 @@
 try:
     import bellhelper.redisHelper as rh
     import bellhelper.streamExceptions as stExcept
+    import bellhelper.rollup as rollup
+    import bellhelper.streamCache as streamCache
 except Exception:
     import redisHelper as rh
     import streamExceptions as stExcept
+    import rollup as rollup
+    import streamCache as streamCache
 import time
 import numpy as np
 import math as math
@@ -11,6 +15,7 @@ import math as math
 CHANNELCOUNTS = 'monitor:counts'
 CHANNELSTATS = 'monitor:stats'
 CHANNELVIOLATION = 'monitor:violationstats'
+CHANNELCUMULATIVE = 'monitor:counts:cumulative'
 LASTTIMESTAMP = '0-0'
 CONFIGKEY = 'config:timetaggers'
 
@@ -19,39 +24,53 @@ def get_power(redis_db, int_time,
               COUNTTYPE='SB',
               COUNTPATH='VV',
               include_null_counts=False,
-              trim=True, loop_args={}):
+              trim=True, loop_args={}, cumulative=False):
+    '''
+    cumulative: If True, compute the counts from the cumulative counter
+                stream (see get_counts_cumulative) instead of summing every
+                sample of monitor:counts.
+    '''
+    if cumulative:
+        counts_function = get_counts_cumulative
+    else:
+        counts_function = get_counts
     if COUNTPATH == 'All':
-        return get_counts(redis_db, int_time=int_time,
-                          include_null_counts=include_null_counts,
-                          trim=trim, loop_args=loop_args)
+        return counts_function(redis_db, int_time=int_time,
+                               include_null_counts=include_null_counts,
+                               trim=trim, loop_args=loop_args)
     else:
-        counts = get_counts(redis_db, int_time=int_time,
-                            count_path=COUNTPATH,
-                            include_null_counts=include_null_counts,
-                            trim=trim, loop_args=loop_args)[COUNTPATH]
+        counts = counts_function(redis_db, int_time=int_time,
+                                 count_path=COUNTPATH,
+                                 include_null_counts=include_null_counts,
+                                 trim=trim, loop_args=loop_args)[COUNTPATH]
         # print(counts)
-        if COUNTTYPE == 'SA':
-            val = counts[0]
-        elif COUNTTYPE == 'Coinc':
-            val = counts[1]
-        elif COUNTTYPE == 'SB':
-            val = counts[2]
-        elif COUNTTYPE == 'eff_a':
-            val = counts[3]
-        elif COUNTTYPE == 'eff_b':
-            val = counts[4]
-        elif COUNTTYPE == 'All':
-            val = counts
-        else:
-            val = counts[5]
-        return val
+        return select_count_type(counts, COUNTTYPE)
+
+
+def select_count_type(counts, count_type='SB'):
+    '''Picks one value out of a get_counts array.'''
+    if count_type == 'SA':
+        val = counts[0]
+    elif count_type == 'Coinc':
+        val = counts[1]
+    elif count_type == 'SB':
+        val = counts[2]
+    elif count_type == 'eff_a':
+        val = counts[3]
+    elif count_type == 'eff_b':
+        val = counts[4]
+    elif count_type == 'All':
+        val = counts
+    else:
+        val = counts[5]
+    return val
 
 
 def get_counts(r, int_time=0.2, count_path='VV',
                include_null_counts=False,
-               trim=True, loop_args={}):
+               trim=True, loop_args={}, use_rollup=False):
     '''
-    r: Redis connection
+    r: Redis connection, or a redis config dict to use the shared pool
     intTime: The amount of time to integrate for. This is rounded to the nearest integer multiple
              of 0.2s in the default configuration. So asking for 1.5s of data will actually return 1.6s.
              It depends on what the redis integration time value is set to–if that changes from 0.2s to
@@ -64,43 +83,93 @@ def get_counts(r, int_time=0.2, count_path='VV',
                        zero singles is obtained.
     'numTries': The number of attempts to fetch a valid result.
     'trim': Only return results where 'isTrim' is True.
+    use_rollup: If True and a rollup stream no longer than int_time exists,
+                return the most recently completed int_time of data from
+                the coarsest such stream instead of waiting for new
+                samples. Falls back to the raw stream if the rollup
+                entries don't cover int_time (see get_rollup_entries) or
+                trim is False.
     Returns: Array of [singlesAlice, Coinc, SinglesBob, EfficiencyAlice, EfficiencyBob, EfficiencyAB]
              or returns None if no valid counts obtained.
     '''
-    err_check_args = {'count_path': count_path,
-                      'include_null_counts': include_null_counts, 'trim': trim}
-
-    # numTries=numTries, timeOut=timeOut, sleepTime=sleepTime)
-    count_list = rh.loop_counts(
-        r, CHANNELCOUNTS, error_check_counts, err_check_args,
-        intTime=int_time, **loop_args)
+    r = rh.get_redis(r)
+    count_list = None
+    if use_rollup and trim:
+        count_list = get_rollup_entries(r, CHANNELCOUNTS, int_time)
 
     if count_list is None:
-        return None
+        err_check_args = {'count_path': count_path,
+                          'include_null_counts': include_null_counts,
+                          'trim': trim}
 
-    count_dict = {}
-    keys = count_list[0].keys()
-    for count_type in keys:
-        if count_path in count_type:
-            sa = 0
-            sb = 0
-            coinc = 0
-            for c in count_list:
-                sa += int(c[count_type]['As'])
-                sb += int(c[count_type]['Bs'])
-                coinc += int(c[count_type]['C'])
-            eff_a, eff_b, eff_ab = calc_efficiency(sa, sb, coinc)
-            count_array = [sa, coinc, sb, eff_a, eff_b, eff_ab]
-            count_dict[count_type] = count_array
+        # numTries=numTries, timeOut=timeOut, sleepTime=sleepTime)
+        count_list = loop_counts(
+            r, CHANNELCOUNTS, error_check_counts, err_check_args,
+            intTime=int_time, **loop_args)
 
-    return count_dict
+    return aggregate_counts(count_list, count_path)
+
+
+def get_range(r, t0, t1=None, bin_width=1., count_path='VV', trim=True,
+              channel=CHANNELCOUNTS, batch_size=1000):
+    '''
+    Counts published on a counts stream between t0 and t1, summed into
+    bins of bin_width seconds, for plots and post-mortems.
+    r: Redis connection, or a redis config dict to use the shared pool
+    t0, t1: Start and end of the range in seconds since the epoch. t1 of
+            None reads to the end of the stream.
+    count_path: The count type to bin, e.g. 'VV' or 'VV_PC'.
+    trim: Only include samples where 'isTrim' is True.
+    channel: The stream to read. Use a rollup stream such as
+             'monitor:counts:10s' for long ranges.
+    Returns: A dictionary of numpy arrays with one element per bin:
+             't' (bin start time), 'SA', 'Coinc', 'SB', 'eff_a', 'eff_b',
+             'eff_ab', 'intTime' and 'nSamples'. Bins without samples
+             have zero counts and efficiencies.
+    '''
+    r = rh.get_redis(r)
+    if t1 is None:
+        t1 = time.time()
+    entries = rh.get_range(r, channel, t0, t1, batchSize=batch_size)
+
+    t = []
+    samples = []
+    int_times = []
+    for timestamp, entry in entries:
+        if count_path not in entry:
+            continue
+        if trim and not entry.get('isTrim', True):
+            continue
+        counts = entry[count_path]
+        t.append(int(timestamp.split('-')[0])/1000.)
+        samples.append([counts['As'], counts['Bs'], counts['C']])
+        int_times.append(entry.get('integrationTime', 0.))
+
+    n_bins = max(int(math.ceil((t1 - t0)/float(bin_width))), 1)
+    t = np.array(t, dtype=float)
+    samples = np.array(samples, dtype=np.int64).reshape(-1, 3)
+    idx = np.floor((t - t0)/bin_width).astype(int)
+    idx = np.clip(idx, 0, n_bins - 1)
+
+    def bin_sum(weights):
+        return np.bincount(idx, weights=weights, minlength=n_bins)
+
+    sa = bin_sum(samples[:, 0]).astype(np.int64)
+    sb = bin_sum(samples[:, 1]).astype(np.int64)
+    coinc = bin_sum(samples[:, 2]).astype(np.int64)
+    eff_a, eff_b, eff_ab = calc_efficiency_array(sa, sb, coinc)
+    return {'t': t0 + bin_width*np.arange(n_bins),
+            'SA': sa, 'Coinc': coinc, 'SB': sb,
+            'eff_a': eff_a, 'eff_b': eff_b, 'eff_ab': eff_ab,
+            'intTime': bin_sum(np.array(int_times, dtype=float)),
+            'nSamples': np.bincount(idx, minlength=n_bins)}
 
 
 def get_violation(r, int_time=0.2, count_path='VV',
                   include_null_counts=False,
                   trim=True, loop_args={}):
     '''
-    r: Redis connection
+    r: Redis connection, or a redis config dict to use the shared pool
     intTime: The amount of time to integrate for. This is rounded to
                   the nearest integer multiple
              of 0.2s in the default configuration.
@@ -122,35 +191,23 @@ def get_violation(r, int_time=0.2, count_path='VV',
              contains the countPath and the value is
              a 2D numpy array of all the aggregated counts.
     '''
+    r = rh.get_redis(r)
     err_check_args = {'count_path': count_path,
                       'include_null_counts': include_null_counts, 'trim': trim}
     loop_args['intTime'] = int_time
 
-    count_list = rh.loop_counts(
+    count_list = loop_counts(
         r, CHANNELVIOLATION, error_check_violation,
         err_check_args, **loop_args)
 
-    if count_list is None:
-        return None
-
-    count_dict = {}
-    keys = count_list[0].keys()
-    for count_type in keys:
-        if count_path in count_type:
-            count_matrix = np.zeros((4, 4))
-            for c in count_list:
-                counts = np.array(c[count_type])
-                count_matrix += counts
-            count_matrix = count_matrix.astype(int)
-            count_dict[count_type] = count_matrix
-    return count_dict
+    return aggregate_violation(count_list, count_path)
 
 
 def get_stats(r, int_time=0.5, include_null_counts=False,
               extended_checks=False, extended_check_args={},
-              loop_args={}, det_channels={}):
+              loop_args={}, det_channels={}, use_rollup=False):
     '''
-    r: Redis connection
+    r: Redis connection, or a redis config dict to use the shared pool
     int_time: The amount of time to integrate for. This is rounded to the nearest integer multiple
              of 0.2s in the default configuration. So asking for 1.5s of data will actually return 1.6s.
              It depends on what the redis integration time value is set to–if that changes from 0.2s to
@@ -158,32 +215,328 @@ def get_stats(r, int_time=0.5, include_null_counts=False,
     include_null_counts: Allow either of the singles counts to be 0 if True. If False waits until a non
                        zero singles is obtained.
     loop_args = A dictionary of kwargs to be passed to the loop_counts() function.
+    use_rollup: If True, return the most recently completed int_time of data
+                from the coarsest rollup stream no longer than int_time (see
+                get_counts).
 
     Returns: a dictionary with the aggregated counts on each timetagger channel for each party.
              or returns None if no valid counts obtained.
     '''
-    err_check_args = {'include_null_counts': include_null_counts,
-                      'extended_checks': extended_checks,
-                      'extended_check_args': extended_check_args,
-                      'det_chnls': det_channels}
-    loop_args['intTime'] = int_time
+    r = rh.get_redis(r)
+    count_list = None
+    if use_rollup:
+        count_list = get_rollup_entries(r, CHANNELSTATS, int_time)
+
+    if count_list is None:
+        err_check_args = {'include_null_counts': include_null_counts,
+                          'extended_checks': extended_checks,
+                          'extended_check_args': extended_check_args,
+                          'det_chnls': det_channels}
+        loop_args['intTime'] = int_time
+
+        count_list = loop_counts(
+            r, CHANNELSTATS, error_check_stats, err_check_args, **loop_args)
 
-    count_list = rh.loop_counts(
-        r, CHANNELSTATS, error_check_stats, err_check_args, **loop_args)
+    return aggregate_stats(count_list)
 
+
+def aggregate_counts(count_list, count_path='VV'):
+    '''Sums the counts entries in count_list for every count type
+    containing count_path and returns get_counts' dictionary.'''
+    if count_list is None:
+        return None
+
+    count_dict = {}
+    keys = [k for k in count_list[0].keys() if count_path in k]
+    if len(keys) == 0:
+        return count_dict
+    # Stack every sample into a (samples, count types, [As, Bs, C]) array
+    # and reduce over the samples in one go.
+    samples = np.array([[[c[k]['As'], c[k]['Bs'], c[k]['C']] for k in keys]
+                        for c in count_list], dtype=np.int64)
+    sa, sb, coinc = samples.sum(axis=0).T
+    eff_a, eff_b, eff_ab = calc_efficiency_array(sa, sb, coinc)
+    for i, count_type in enumerate(keys):
+        count_array = [int(sa[i]), int(coinc[i]), int(sb[i]),
+                       float(eff_a[i]), float(eff_b[i]), float(eff_ab[i])]
+        count_dict[count_type] = count_array
+
+    return count_dict
+
+
+def aggregate_violation(count_list, count_path='VV'):
+    '''Sums the violation matrices in count_list for every count type
+    containing count_path.'''
+    if count_list is None:
+        return None
+
+    count_dict = {}
+    keys = [k for k in count_list[0].keys() if count_path in k]
+    if len(keys) == 0:
+        return count_dict
+    # (samples, count types, 4, 4) summed over the samples
+    samples = np.array([[c[k] for k in keys] for c in count_list],
+                       dtype=np.int64)
+    count_matrices = samples.sum(axis=0).astype(int)
+    for i, count_type in enumerate(keys):
+        count_dict[count_type] = count_matrices[i]
+    return count_dict
+
+
+def aggregate_stats(count_list):
+    '''Sums the per-channel stats entries in count_list for each party.'''
     if count_list is None:
         return None
 
     parties = ('alice', 'bob')
 
+    samples = np.array([[c[p] for p in parties] for c in count_list],
+                       dtype=np.int64)
+    totals = samples.sum(axis=0).astype(int)
     count_dict = {}
-    for p in parties:
-        count_dict[p] = np.zeros(8).astype(int)
+    for i, p in enumerate(parties):
+        count_dict[p] = totals[i]
 
-    for c in count_list:
-        for p in parties:
-            count_dict[p] += np.array(c[p]).astype(int)
+    return count_dict
+
+
+def enable_stream_cache(r, channels=(CHANNELCOUNTS, CHANNELSTATS,
+                                     CHANNELVIOLATION), max_len=600):
+    '''
+    Starts a background reader that tails the monitor streams once for the
+    whole process. get_counts, get_stats and get_violation on the same
+    redis server are then served from its buffer instead of each polling
+    the stream.
+    '''
+    return streamCache.get_stream_cache(r, channels=channels, maxLen=max_len)
+
+
+def disable_stream_cache(r):
+    streamCache.stop_stream_cache(r)
+
+
+def loop_counts(r, channel, error_function, err_check_args, **loop_args):
+    '''rh.loop_counts, served from the stream cache if one is running for
+    r and caches channel.'''
+    cache = streamCache.get_stream_cache(r)
+    if (cache is not None) and cache.is_running() and \
+            (channel in cache.channels):
+        return cache.loop_counts(channel, error_function, err_check_args,
+                                 **loop_args)
+    return rh.loop_counts(r, channel, error_function, err_check_args,
+                          **loop_args)
+
+
+def get_rollup_entries(r, channel, int_time):
+    '''
+    Returns the most recent entries of the coarsest rollup stream of
+    channel whose summed integrationTime covers int_time, or None if
+    int_time is shorter than every rollup resolution or the rollup doesn't
+    cover it. Entries short of samples (dropped or untrimmed) are made up
+    by older ones, but a partial entry from the start of the rollup
+    service ends the search, so callers fall back to the raw stream.
+    '''
+    int_time = float(int_time)
+    resolution = rollup.select_resolution(int_time)
+    if resolution is None:
+        return None
+    # ceil as in loop_counts, plus one entry to make up for short ones
+    n_entries = max(int(math.ceil(int_time/resolution - 1e-9)), 1)
+    msg = rh.get_last_entry(r, rollup.rollup_channel(channel, resolution),
+                            count=n_entries + 1)
+    if msg is None:
+        return None
+    entries = []
+    covered = 0.
+    # get_last_entry returns the newest entry first
+    for timestamp, entry in msg:
+        if entry.get('partial', 0):
+            return None
+        entries.append(entry)
+        covered += float(entry.get('integrationTime', 0.))
+        if covered >= int_time - rollup.COVERAGETOL:
+            return entries
+    return None
+
+
+def start_rollup_service(r, resolutions=rollup.ROLLUPRESOLUTIONS,
+                         max_len=rollup.ROLLUPMAXLEN):
+    '''Starts a background RollupService for the counts and stats streams
+    and returns it.'''
+    service = rollup.RollupService(r, channels=(CHANNELCOUNTS, CHANNELSTATS),
+                                   resolutions=resolutions, max_len=max_len)
+    service.start()
+    return service
+
+
+def publish_monitor_data(r, counts=None, stats=None, violation=None,
+                         max_len=100, binary=False, cumulative_counter=None):
+    '''
+    Publishes the counts, stats and violation data of one update to their
+    monitor streams in a single redis transaction, so that consumers that
+    correlate the streams always see a consistent set. Entries that are
+    None are skipped.
+    cumulative_counter: a CumulativeCounter. If given, the counts are added
+                        to it and its running totals are published to the
+                        cumulative counts stream in the same transaction.
+    Returns a dictionary of channel: entry id.
+    '''
+    r = rh.get_redis(r)
+    channelData = {}
+    if counts is not None:
+        channelData[CHANNELCOUNTS] = counts
+        if cumulative_counter is not None:
+            cumulative_counter.add(counts)
+            channelData[CHANNELCUMULATIVE] = cumulative_counter.get_entry()
+    if stats is not None:
+        channelData[CHANNELSTATS] = stats
+    if violation is not None:
+        channelData[CHANNELVIOLATION] = violation
+    if len(channelData) == 0:
+        return {}
+    return rh.send_many_to_redis(r, channelData, max_len=max_len,
+                                 binary=binary, approximate=True)
+
+
+class CumulativeCounter():
+    """
+    Running totals of the singles and coincidences of every count path
+    published to monitor:counts. Each entry of the cumulative stream holds
+    the totals over all samples ('all') and over the trimmed samples only
+    ('trim'), as [As, Bs, C] per count path, along with the number of
+    samples of each kind. The counts over any window are then the
+    difference of two entries. The epoch identifies the counter so that a
+    restarted publisher is never differenced against an old one.
+    """
+
+    def __init__(self):
+        self.epoch = int(time.time()*1000)
+        self.n = 0
+        self.n_trim = 0
+        self.totals = {'all': {}, 'trim': {}}
+        self.integration_time = None
+
+    def add(self, counts):
+        is_trim = bool(counts.get('isTrim', True))
+        self.n += 1
+        if is_trim:
+            self.n_trim += 1
+        if 'integrationTime' in counts:
+            self.integration_time = counts['integrationTime']
+        for key, val in counts.items():
+            if not (isinstance(val, dict) and 'As' in val):
+                continue
+            sample = [int(val['As']), int(val['Bs']), int(val['C'])]
+            kinds = ('all', 'trim') if is_trim else ('all',)
+            for kind in kinds:
+                total = self.totals[kind].setdefault(key, [0, 0, 0])
+                for i in range(3):
+                    total[i] += sample[i]
+
+    def get_entry(self):
+        entry = {'epoch': self.epoch,
+                 'n': self.n,
+                 'nTrim': self.n_trim,
+                 'integrationTime': self.integration_time,
+                 'all': self.totals['all'],
+                 'trim': self.totals['trim']}
+        return entry
+
+
+def _cumulative_reached(entry, start, n_key, target):
+    return (entry['epoch'] == start['epoch']) and (entry[n_key] >= target)
+
+
+def get_counts_cumulative(r, int_time=0.2, count_path='VV',
+                          include_null_counts=False, trim=True,
+                          loop_args={}):
+    '''
+    Same result as get_counts, computed as the difference between two
+    entries of the cumulative counts stream instead of by reading and
+    summing every sample in the window. The window starts at the first
+    entry published after the call, as in get_counts.
+    loop_args: 'numTries', 'sleepTime' and 'timeOut' are honoured as in
+               loop_counts.
+    Unlike get_counts, the individual samples are not checked for
+    repeated counts.
+    '''
+    r = rh.get_redis(r)
+    channel = CHANNELCUMULATIVE
+    kind = 'trim' if trim else 'all'
+    n_key = 'nTrim' if trim else 'n'
+    watchdog = rh.ReadWatchdog(channel,
+                               numTries=loop_args.get('numTries', -1),
+                               timeOut=loop_args.get('timeOut', None),
+                               sleepTime=loop_args.get('sleepTime', 0.05),
+                               block=True)
+
+    def wait_for_next(last_id):
+        # Block until at least one entry after last_id is available
+        while True:
+            wait = watchdog.wait_time(1.)
+            msg = rh.get_data(r, channel, last_id,
+                              block=max(int(1000*wait), 1))
+            if msg is not None:
+                watchdog.new_entries()
+                return msg
+            watchdog.empty_read()
+
+    last = rh.get_last_entry(r, channel, count=1)
+    if last is None:
+        raise stExcept.StreamFrozenException(channel, numTries=0,
+                                             timeElapsed=0)
+    start_id, start = wait_for_next(last[0][0])[0]
+    integration_time = float(start['integrationTime'])
+    n_samples = int(math.ceil(float(int_time)/integration_time))
+    target = start[n_key] + n_samples
+
+    # Sleep through most of the window instead of reading every sample
+    time.sleep(max(0., (n_samples - 0.5)*integration_time))
+
+    end = None
+    last_id, latest = rh.get_last_entry(r, channel, count=1)[0]
+    while end is None:
+        if latest['epoch'] != start['epoch']:
+            # The publisher restarted; start the window over.
+            start_id, start = last_id, latest
+            target = start[n_key] + n_samples
+        elif _cumulative_reached(latest, start, n_key, target):
+            # Find the first entry that reached the target; it is at most
+            # a few entries back from the latest one.
+            overshoot = latest[n_key] - target
+            recent = r.xrevrange(channel, max=last_id, min=start_id,
+                                 count=overshoot + 1)
+            for ele in reversed(recent):
+                entry = rh.decode_dict(ele[1])
+                if _cumulative_reached(entry, start, n_key, target):
+                    end = entry
+                    break
+            if end is None:
+                end = latest
+            break
+        for last_id, latest in wait_for_next(last_id):
+            if _cumulative_reached(latest, start, n_key, target):
+                end = latest
+                break
 
+    count_dict = {}
+    keys = [k for k in end[kind].keys() if count_path in k]
+    if len(keys) == 0:
+        return count_dict
+    end_totals = np.array([end[kind][k] for k in keys], dtype=np.int64)
+    start_totals = np.array([start[kind].get(k, [0, 0, 0]) for k in keys],
+                            dtype=np.int64)
+    sa, sb, coinc = (end_totals - start_totals).T
+    if not include_null_counts:
+        if np.any(sa[[k == count_path for k in keys]] == 0):
+            raise stExcept.NullCountsException('alice')
+        if np.any(sb[[k == count_path for k in keys]] == 0):
+            raise stExcept.NullCountsException('bob')
+    eff_a, eff_b, eff_ab = calc_efficiency_array(sa, sb, coinc)
+    for i, count_type in enumerate(keys):
+        count_dict[count_type] = [int(sa[i]), int(coinc[i]), int(sb[i]),
+                                  float(eff_a[i]), float(eff_b[i]),
+                                  float(eff_ab[i])]
     return count_dict
 
 
@@ -202,6 +555,24 @@ def calc_efficiency(sa, sb, coinc):
         return eff
 
 
+def calc_efficiency_array(sa, sb, coinc):
+    '''
+    Vectorised version of calc_efficiency for arrays of singles and
+    coincidence counts. Efficiencies are 0 wherever either singles is 0.
+    '''
+    sig = 1
+    sa = np.asarray(sa, dtype=float)
+    sb = np.asarray(sb, dtype=float)
+    coinc = np.asarray(coinc, dtype=float)
+    valid = (sa > 0) & (sb > 0)
+    sa_safe = np.where(valid, sa, 1.)
+    sb_safe = np.where(valid, sb, 1.)
+    eff_a = np.where(valid, 100*coinc/sb_safe, 0.)
+    eff_b = np.where(valid, 100*coinc/sa_safe, 0.)
+    eff_ab = np.where(valid, 100*coinc/np.sqrt(sa_safe*sb_safe), 0.)
+    return np.round(eff_a, sig), np.round(eff_b, sig), np.round(eff_ab, sig)
+
+
 def error_check_counts(previous_counts, current_counts,
                        count_path='VV', include_null_counts=False,
                        trim=True):
@@ -432,53 +803,66 @@ def set_get_pockels_window(r, config_key,
                            p_start=None, p_length=None):
     '''
    Function to change the integration time.
-   r: Redis connection
+   r: Redis connection, or a redis config dict to use the shared pool
    p_start:    The new Pockels cell start window.
                Will remain the same if None is passed.
    p_start:    The new Pockels cell window length.
                Will remain the same if None is passed.
     return value:    The previous start and length of PC window
    '''
-    config = rh.get_config(r, config_key)
-    p_start_old = config['pockelProp']['start']
-    p_length_old = config['pockelProp']['length']
-    p_start = pockels_value_settr(p_start, p_start_old)
-    p_length = pockels_value_settr(p_length, p_length_old)
-    config['pockelProp']['start'] = p_start
-    config['pockelProp']['length'] = p_length
-    rh.set_config(r, config, config_key)
-
-    return p_start, p_length
+    r = rh.get_redis(r)
+    config_client = rh.get_config_client(r, config_key)
+    new_window = {}
+
+    def modify(config):
+        pockel_prop = config['pockelProp']
+        start = pockels_value_settr(p_start, pockel_prop['start'])
+        length = pockels_value_settr(p_length, pockel_prop['length'])
+        new_window['start'], new_window['length'] = start, length
+        if (start == pockel_prop['start']) and \
+                (length == pockel_prop['length']):
+            return None
+        pockel_prop['start'] = start
+        pockel_prop['length'] = length
+        return config
+
+    config_client.update(modify)
+    return new_window['start'], new_window['length']
 
 
 def set_integration_time(r, int_time, config_key):
     '''
     Function to change the integration time.
-    r: Redis connection
+    r: Redis connection, or a redis config dict to use the shared pool
     int_time:    The new integration time
     config_key:  The redis stream containing the configuration dictionary
     Returns:    The previous integration time.
     '''
-    config = rh.get_config(r, config_key)
-    current_int_time = config['INT_TIME']
-    if float(current_int_time) != float(int_time):
+    r = rh.get_redis(r)
+    config_client = rh.get_config_client(r, config_key)
+
+    def modify(config):
+        if float(config['INT_TIME']) == float(int_time):
+            return None
         config['INT_TIME'] = float(int_time)
-        rh.set_config(r, config, config_key)
+        return config
 
-    return current_int_time
+    old_config = config_client.update(modify)
+    return old_config['INT_TIME']
 
 
 def get_integration_time(r, config_key=None):
     '''
     Function to fetch the integration time.
-    r: Redis connection
+    r: Redis connection, or a redis config dict to use the shared pool
     config_key:  The redis stream containing the configuration dictionary
     Returns:    The current integration time.
     '''
     if config_key is None:
         config_key = CONFIGKEY
-    config = rh.get_config(r, config_key)
-    current_int_time = config['INT_TIME']
+    r = rh.get_redis(r)
+    current_int_time = rh.get_config_client(r, config_key).get_value(
+        'INT_TIME')
     return current_int_time
 
 
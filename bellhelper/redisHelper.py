@@ -5,23 +5,102 @@ containing configuration files.
 '''
 import json
 import redis
-# import copy
+import copy
 import yaml
 import math
 import time
+import threading
+try:
+    from redis.retry import Retry
+    from redis.backoff import ExponentialBackoff
+except ImportError:
+    Retry = None
 try:
     import bellhelper.streamExceptions as stExcept
+    import bellhelper.streamCodec as codec
 except Exception as e:
     import streamExceptions as stExcept
+    import streamCodec as codec
+
+# Connection pools shared by every connection made in this process,
+# keyed by (ip, port, db).
+CONNECTIONPOOLS = {}
+POOLLOCK = threading.Lock()
+HEALTHCHECKINTERVAL = 15
+# Margin in seconds on the time between the end of a sample and the
+# publication of its stream entry. Entries may report the part of it they
+# know (fetch margin, fetch and analysis) as 'publishLatency'; the margin
+# is added on top to cover the publisher's own delay.
+PUBLISHLATENCY = 0.5
+
+
+def get_connection_pool(redisConfig):
+    '''Returns the process-wide connection pool for a redis config,
+    creating it on first use.'''
+    key = (redisConfig['ip'], int(redisConfig['port']),
+           int(redisConfig.get('db', 0)))
+    with POOLLOCK:
+        pool = CONNECTIONPOOLS.get(key)
+        if pool is None:
+            poolArgs = {'host': key[0], 'port': key[1], 'db': key[2],
+                        'max_connections': redisConfig.get('max_connections'),
+                        'health_check_interval': HEALTHCHECKINTERVAL,
+                        'socket_keepalive': True,
+                        'socket_connect_timeout': 5}
+            if Retry is not None:
+                # Transparently reconnect after transient drops
+                poolArgs['retry'] = Retry(ExponentialBackoff(cap=1.,
+                                                             base=0.01), 3)
+                poolArgs['retry_on_error'] = [redis.ConnectionError,
+                                              redis.TimeoutError]
+            pool = redis.ConnectionPool(**poolArgs)
+            CONNECTIONPOOLS[key] = pool
+    return pool
+
+
+def connect_to_redis(redisConfig, shared=True):
+    '''Returns a redis connection. By default it draws its sockets from
+    the process-wide pool for that server, so every caller shares them.
+    Pass shared=False for a private connection.'''
+    if shared:
+        pool = get_connection_pool(redisConfig)
+        r = redis.Redis(connection_pool=pool)
+    else:
+        r = redis.Redis(host=redisConfig['ip'],
+                        port=redisConfig['port'],
+                        db=redisConfig['db'])
+    return r
 
 
-def connect_to_redis(redisConfig):
-    r = redis.Redis(host=redisConfig['ip'],
-                    port=redisConfig['port'],
-                    db=redisConfig['db'])
+def get_redis(r):
+    '''Accepts either a redis connection or a redis config dictionary
+    and returns a connection on the shared pool for the latter.'''
+    if isinstance(r, dict):
+        return connect_to_redis(r)
     return r
 
 
+def check_connection(r):
+    '''Ping the server. If that fails, drop the pooled sockets and try
+    once more with a fresh connection. Returns True if the server
+    responds.'''
+    try:
+        return r.ping()
+    except (redis.ConnectionError, redis.TimeoutError):
+        r.connection_pool.disconnect()
+    try:
+        return r.ping()
+    except (redis.ConnectionError, redis.TimeoutError):
+        return False
+
+
+def close_connection_pools():
+    with POOLLOCK:
+        for pool in CONNECTIONPOOLS.values():
+            pool.disconnect()
+        CONNECTIONPOOLS.clear()
+
+
 def get_last_entry(r, channel, count=1):
     '''returns a list of entries'''
     msg = r.xrevrange(channel, count=count)
@@ -31,6 +110,27 @@ def get_last_entry(r, channel, count=1):
     return msgDecode
 
 
+def get_range(r, channel, t0=None, t1=None, batchSize=1000):
+    '''
+    Returns the list of (timestamp, entry) published on channel between
+    t0 and t1 (seconds since the epoch, None for the start or end of the
+    stream). The range is fetched with XRANGE in pages of batchSize
+    entries so that long ranges don't block the server.
+    '''
+    start = '-' if t0 is None else str(int(1000*t0))
+    end = '+' if t1 is None else str(int(1000*t1))
+    msgDecode = []
+    while True:
+        msg = r.xrange(channel, min=start, max=end, count=batchSize)
+        msgDecode += [(ele[0].decode(), decode_dict(ele[1])) for ele in msg]
+        if len(msg) < batchSize:
+            break
+        # Continue just after the last id returned
+        ms, seq = msg[-1][0].decode().split('-')
+        start = '%s-%d' % (ms, int(seq) + 1)
+    return msgDecode
+
+
 def set_key_to_expire(r, channel, time):
     '''sets an expiration time for a channel.
     time must be an int number of seconds.
@@ -59,17 +159,23 @@ def is_stream_alive(r, channel, timeOut):
     return alive, lastUpdate, lastItem
 
 
-def get_data(r, channel, lastTimeStamp, count=None):
+def get_data(r, channel, lastTimeStamp, count=None, block=None):
+    '''Returns the entries after lastTimeStamp. If block is an int, wait up
+    to that many milliseconds on the server for a new entry to arrive.'''
     stream = {}
     stream = {channel: lastTimeStamp}
-    msg = r.xread(stream, count=count)
-    if len(msg) == 0:
+    msg = r.xread(stream, count=count, block=block)
+    if not msg:
         return None
     msgDecode = decode_data(msg[0])
     return msgDecode
 
 
-def send_to_redis(r, channel, data, max_len=100):
+def encode_entry(data, binary=False):
+    '''Returns the fields of a stream entry encoded as JSON, or with the
+    binary codec in streamCodec if binary is True.'''
+    if binary:
+        return codec.encode_dict(data)
     returnDict = {}
     for key in data.keys():
         try:
@@ -77,10 +183,46 @@ def send_to_redis(r, channel, data, max_len=100):
         except Exception:
             for k in data[key].keys():
                 returnDict[key][k] = json.dumps(data[key][k])
-    msg = r.xadd(channel, returnDict, maxlen=max_len)
+    return returnDict
+
+
+def send_to_redis(r, channel, data, max_len=100, binary=False,
+                  approximate=False):
+    '''Adds data to a stream. With binary=True the fields are written with
+    the compact binary codec in streamCodec instead of as JSON. Readers
+    detect the encoding automatically.'''
+    returnDict = encode_entry(data, binary=binary)
+    msg = r.xadd(channel, returnDict, maxlen=max_len,
+                 approximate=approximate)
     return msg
 
 
+def send_many_to_redis(r, channelData, max_len=100, binary=False,
+                       approximate=True, transaction=True):
+    '''
+    Adds one entry to each of several streams in a single round trip.
+    channelData: dictionary of channel: data.
+    max_len:     Maximum stream length. Either an int for all the streams or
+                 a dictionary keyed by channel.
+    approximate: Trim the streams with MAXLEN ~, which lets redis trim whole
+                 nodes at a time and is much cheaper than an exact trim.
+    transaction: Wrap the writes in MULTI/EXEC so that consumers never see
+                 one stream updated without the others.
+    Returns a dictionary of channel: entry id.
+    '''
+    pipe = r.pipeline(transaction=transaction)
+    channels = list(channelData.keys())
+    for channel in channels:
+        if isinstance(max_len, dict):
+            maxLen = max_len.get(channel, 100)
+        else:
+            maxLen = max_len
+        pipe.xadd(channel, encode_entry(channelData[channel], binary=binary),
+                  maxlen=maxLen, approximate=approximate)
+    ids = pipe.execute()
+    return dict(zip(channels, ids))
+
+
 def decode_data(rawdata):
     retChannel = rawdata[0]
     encodedData = rawdata[1]
@@ -94,6 +236,8 @@ def decode_data(rawdata):
 
 
 def decode_dict(dict):
+    if codec.is_binary(dict):
+        return codec.decode_dict(dict)
     retDict = {}
     for key in dict.keys():
         val = dict[key].decode()
@@ -107,8 +251,13 @@ def decode_dict(dict):
 
 
 def set_config(r, config, configKey):
+    '''Stores the config and bumps its version key so that cached copies
+    held by ConfigClient objects are invalidated.'''
     configJSON = json.dumps(config)
-    r.set(configKey, configJSON)
+    pipe = r.pipeline(transaction=True)
+    pipe.set(configKey, configJSON)
+    pipe.incr(config_version_key(configKey))
+    pipe.execute()
     return configJSON
 
 
@@ -118,6 +267,161 @@ def get_config(r, configKey):
     return config
 
 
+def config_version_key(configKey):
+    return configKey + ':version'
+
+
+class ConfigClient():
+    """
+    Keeps a parsed copy of a config stored in redis so that frequent
+    parameter reads do not need a GET and a json.loads of the whole
+    config. The cache is invalidated by keyspace notifications on the
+    config key when the server has them enabled (notify-keyspace-events
+    including K and $ or A). Otherwise the version key bumped by
+    set_config is checked on every read, which is a single small GET.
+    maxAge bounds how long a cached copy is used in any case, which
+    covers writers that SET the config key without bumping its version.
+    """
+
+    def __init__(self, r, configKey, useNotifications=True, maxAge=5.):
+        self.r = r
+        self.configKey = configKey
+        self.versionKey = config_version_key(configKey)
+        self.maxAge = maxAge
+        self.config = None
+        self.version = None
+        self.lastRefresh = 0.
+        self.dirty = True
+        self.lock = threading.Lock()
+        self.pubsubThread = None
+        if useNotifications:
+            self.subscribe()
+
+    def notifications_enabled(self):
+        try:
+            flags = self.r.config_get('notify-keyspace-events')
+            flags = flags.get('notify-keyspace-events', '')
+        except redis.RedisError:
+            return False
+        return ('K' in flags) and (('$' in flags) or ('A' in flags))
+
+    def subscribe(self):
+        '''Listen for changes to the config key. Returns True if the
+        notifications are available.'''
+        if not self.notifications_enabled():
+            return False
+        db = self.r.connection_pool.connection_kwargs.get('db', 0)
+        channel = '__keyspace@%d__:%s' % (db, self.configKey)
+        pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: self._on_change})
+        self.pubsubThread = pubsub.run_in_thread(sleep_time=1.,
+                                                 daemon=True)
+        return True
+
+    def close(self):
+        if self.pubsubThread is not None:
+            self.pubsubThread.stop()
+            self.pubsubThread = None
+
+    def _on_change(self, msg):
+        self.dirty = True
+
+    def _is_stale(self):
+        if self.config is None:
+            return True
+        if (self.maxAge is not None and
+                time.time() - self.lastRefresh > self.maxAge):
+            return True
+        if self.pubsubThread is not None:
+            return self.dirty
+        return self.r.get(self.versionKey) != self.version
+
+    def refresh(self):
+        with self.lock:
+            self.dirty = False
+            pipe = self.r.pipeline(transaction=True)
+            pipe.get(self.versionKey)
+            pipe.get(self.configKey)
+            version, msg = pipe.execute()
+            self.version = version
+            self.config = json.loads(msg)
+            self.lastRefresh = time.time()
+        return self.config
+
+    def get(self):
+        '''Returns a copy of the config, re-reading it only if changed.'''
+        if self._is_stale():
+            self.refresh()
+        return copy.deepcopy(self.config)
+
+    def get_value(self, *keys):
+        '''Returns a single (nested) value from the config without copying
+        the whole config, e.g. get_value('pockelProp', 'start').'''
+        if self._is_stale():
+            self.refresh()
+        val = self.config
+        for key in keys:
+            val = val[key]
+        return copy.deepcopy(val)
+
+    def set(self, config):
+        '''Replaces the whole config. To change some fields of it, use
+        update so that changes made by other clients are not lost.'''
+        set_config(self.r, config, self.configKey)
+        self.refresh()
+        return config
+
+    def update(self, modify):
+        '''
+        Read-modify-write of the config in a WATCH/MULTI transaction, so
+        it always starts from the config currently in redis (never the
+        cached copy) and is retried if another client writes the config
+        in between.
+        modify: Function taking the current config and returning the new
+                one, or None to leave it unchanged.
+        Returns the config as it was before the update.
+        '''
+        with self.r.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(self.configKey)
+                    current = json.loads(pipe.get(self.configKey))
+                    config = modify(copy.deepcopy(current))
+                    if config is None:
+                        pipe.unwatch()
+                        break
+                    pipe.multi()
+                    pipe.set(self.configKey, json.dumps(config))
+                    pipe.incr(self.versionKey)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        self.refresh()
+        return current
+
+
+CONFIGCLIENTS = {}
+
+
+def get_config_client(r, configKey):
+    '''Returns the ConfigClient shared by every caller using the same
+    shared connection pool (see connect_to_redis) and config key.
+    Connections with a private pool get a new client without a
+    notification thread, which is not cached.'''
+    pool = r.connection_pool
+    with POOLLOCK:
+        shared = any(pool is p for p in CONNECTIONPOOLS.values())
+        if not shared:
+            return ConfigClient(r, configKey, useNotifications=False)
+        key = (id(pool), configKey)
+        client = CONFIGCLIENTS.get(key)
+        if client is None:
+            client = ConfigClient(r, configKey)
+            CONFIGCLIENTS[key] = client
+    return client
+
+
 def load_config_from_file(fname):
     config_fp = open(fname, 'r')
     config = yaml.load(config_fp, Loader=yaml.SafeLoader)
@@ -143,76 +447,175 @@ def set_key_value(d, key, val):
     return d
 
 
+def server_time(r):
+    '''Current time of the redis server in seconds since the epoch. Stream
+    entry ids are stamped with this clock, not the local one.'''
+    sec, usec = r.time()
+    return int(sec) + int(usec)/1e6
+
+
+def sample_start_time(timeStamp, counts, latency=None):
+    '''
+    Earliest time the sample in a stream entry can have started, in
+    seconds since the epoch on the redis server's clock: the time the
+    entry was published minus its integration time and the time between
+    the end of the sample and its publication.
+    latency: Publication latency in seconds. Defaults to the entry's
+             'publishLatency' field, if it has one, plus PUBLISHLATENCY.
+    '''
+    published = int(timeStamp.split('-')[0])/1000.
+    if latency is None:
+        latency = float(counts.get('publishLatency', 0.)) + PUBLISHLATENCY
+    return (published - float(counts.get('integrationTime', 0.)) -
+            float(latency))
+
+
+def filter_samples(entries, previous, error_function, errorArgs, countList,
+                   nSamples, startTime=None):
+    '''
+    Checks new stream entries [(timeStamp, counts), ...] and appends the
+    valid ones to countList until it holds nSamples. Each entry is checked
+    against the entry before it with error_function, starting from
+    previous, and, if startTime is given, must have started at or after
+    it (see sample_start_time). With previous None the first entry is
+    only used as the reference for the next one.
+    Returns (previous, lastTimeStamp) for the next call.
+    '''
+    lastTimeStamp = None
+    for timeStamp, counts in entries:
+        lastTimeStamp = timeStamp
+        if (previous is not None) and (len(countList) < nSamples):
+            countsValid = error_function(previous, counts, **errorArgs)
+            if countsValid and (startTime is not None):
+                countsValid = (sample_start_time(timeStamp, counts) >=
+                               startTime)
+            if countsValid:
+                countList.append(counts)
+        previous = counts
+    return previous, lastTimeStamp
+
+
+class ReadWatchdog():
+    """
+    Bookkeeping of empty reads for the loop_counts variants. Raises
+    StreamFrozenException after numTries consecutive empty polls of
+    sleepTime (-1 to never raise) and StreamTimeoutException once timeOut
+    seconds have passed since the watchdog was created.
+    block: The reads are blocking waits rather than polls. numTries then
+           stands for numTries*sleepTime seconds without a new entry, so
+           a frozen stream is detected after the same time as when
+           polling.
+    """
+
+    def __init__(self, channel, numTries=-1, timeOut=None, sleepTime=0.05,
+                 block=False):
+        if numTries == 0:
+            numTries = 1
+        self.channel = channel
+        self.numTries = numTries
+        self.timeOut = timeOut
+        self.block = block
+        self.frozenTime = None
+        if block and (numTries > 0):
+            self.frozenTime = numTries*float(sleepTime)
+        self.t1 = time.time()
+        self.tLastEntry = self.t1
+        self.nEmpty = 0
+
+    def wait_time(self, wait):
+        '''Limits a wait in seconds so it doesn't run past timeOut or,
+        for blocking reads, past the time the stream counts as frozen.'''
+        now = time.time()
+        if self.timeOut is not None:
+            wait = min(wait, self.timeOut - (now - self.t1))
+        if self.frozenTime is not None:
+            wait = min(wait, self.frozenTime - (now - self.tLastEntry))
+        return max(wait, 0.001)
+
+    def is_frozen(self, now):
+        if self.numTries <= 0:
+            return False
+        if self.block:
+            return now - self.tLastEntry >= self.frozenTime
+        return self.nEmpty >= self.numTries
+
+    def empty_read(self):
+        '''Records a read that returned no entries.'''
+        self.nEmpty += 1
+        now = time.time()
+        timeElapsed = now - self.t1
+        if self.is_frozen(now):
+            raise stExcept.StreamFrozenException(
+                self.channel, numTries=self.numTries,
+                timeElapsed=timeElapsed)
+        if (self.timeOut is not None) and (timeElapsed > self.timeOut):
+            raise stExcept.StreamTimeoutException(
+                self.channel, timeElapsed=timeElapsed)
+
+    def new_entries(self):
+        self.nEmpty = 0
+        self.tLastEntry = time.time()
+
+
 def loop_counts(r, channel, error_function, errorArgs, intTime=0.2,
-                numTries=-1, sleepTime=0.05, timeOut=None):
-    if numTries == 0:
-        numTries = 1
-
-    msgCounts = get_last_entry(r, channel, count=2)
-    if msgCounts is not None:
-        # Need to grab the second to last timestamp to start with.
-        # We need the current and last
-        LASTTIMESTAMP = msgCounts[0][0]
-        counts = msgCounts[1][1]
-        defaultIntegrationTime = counts['integrationTime']
+                numTries=-1, sleepTime=0.05, timeOut=None, block=True,
+                blockTime=None, startTime=None):
+    '''
+    Collects enough valid entries from channel to cover intTime.
+    Every new entry is checked against the entry before it with
+    error_function. The first entry to arrive after the call is only used
+    as the reference for the next one, so no sample that may have started
+    before the call is returned.
+    block:     If True, wait for new entries with a blocking XREAD that
+               returns as soon as an entry is published. Otherwise poll
+               every sleepTime seconds.
+    blockTime: Server-side timeout of each blocking read in seconds.
+               Defaults to twice the stream integration time.
+    numTries:  Number of consecutive empty polls of sleepTime before a
+               StreamFrozenException is raised. -1 to never raise. When
+               blocking, the exception is raised after numTries*sleepTime
+               seconds without a new entry, the same time as when polling.
+    timeOut:   Total time in seconds before a StreamTimeoutException is
+               raised.
+    startTime: If given, only entries whose sample started at or after
+               this time (seconds since the epoch on the redis server's
+               clock, see server_time and sample_start_time) are
+               returned, e.g. the time the motors settled.
+    '''
+    msgCounts = get_last_entry(r, channel, count=1)
+    if msgCounts is None:
+        raise stExcept.StreamFrozenException(channel, numTries=0,
+                                             timeElapsed=0)
+    lastTimeStamp = msgCounts[0][0]
+    defaultIntegrationTime = msgCounts[0][1]['integrationTime']
 
     nSamples = int(math.ceil(float(intTime)/float(defaultIntegrationTime)))
-    cont = True
 
-    i = 0
+    if block and (blockTime is None):
+        blockTime = 2.*float(defaultIntegrationTime)
+
+    watchdog = ReadWatchdog(channel, numTries=numTries, timeOut=timeOut,
+                            sleepTime=sleepTime, block=block)
     countList = []
-    defaultNumTries = numTries
-    t1 = time.time()
-
-    j = 0
-    while j < nSamples:
-        cont = True
-        numTries = defaultNumTries
-        i = 0
-        while cont:
-            i += 1
+    previousCounts = None
+    while len(countList) < nSamples:
+        if block:
+            # Don't block past the overall timeout or the frozen time
+            wait = watchdog.wait_time(blockTime)
+            msgCounts = get_data(r, channel, lastTimeStamp,
+                                 block=max(int(1000*wait), 1))
+        else:
             time.sleep(sleepTime)
-            msgCounts = get_data(r, channel, LASTTIMESTAMP)
-            # t2 = time.time()
-            # print(i, j, 'Elapsed time:', t2-t1)
-            if (msgCounts is not None) and len(msgCounts) >= 2:
-                # print(msgCounts)
-                # Need to make sure that an update has occured which requires
-                # at least two new entries since the first one.
-                goodCounts, LASTTIMESTAMP = parse_counts(
-                    msgCounts, error_function, errorArgs)
-
-                # inlcudeNullCounts, trim, error_function)
-
-                if len(goodCounts) == 0:
-                    continue
-                else:
-                    samplesAvailable = len(goodCounts)
-                    samplesLeftToAdd = nSamples - j
-
-                    if samplesAvailable <= samplesLeftToAdd:
-                        countsToAdd = goodCounts
-                    else:
-                        countsToAdd = goodCounts[-samplesLeftToAdd:-1]
-                    j += len(countsToAdd)
-                    countList += countsToAdd
-                    break  # end the loop
-            else:
-                timeElapsed = time.time() - t1
-                numTriesExceeded = (i >= numTries) and (numTries > 0)
-
-                if numTriesExceeded:
-                    err = stExcept.StreamFrozenException(channel, numTries=numTries,
-                                                         timeElapsed=timeElapsed)
-                    raise err
-
-                timeOutExceeded = (timeOut is not None) and (
-                    timeElapsed > timeOut)
-                if timeOutExceeded:
-                    err = stExcept.StreamTimeoutException(
-                        channel, timeElapsed=timeElapsed)
-                    raise err
-                continue
+            msgCounts = get_data(r, channel, lastTimeStamp)
+
+        if msgCounts is None:
+            watchdog.empty_read()
+            continue
+
+        watchdog.new_entries()
+        previousCounts, lastTimeStamp = filter_samples(
+            msgCounts, previousCounts, error_function, errorArgs, countList,
+            nSamples, startTime=startTime)
 
     return countList
 
@@ -0,0 +1,186 @@
+'''
+Rollup service for the monitor streams. Tails the raw 0.2 s streams and
+publishes 1 s, 10 s and 60 s aggregates to companion streams
+(e.g. monitor:counts:10s), so that long integrations and dashboards can
+read a few coarse entries instead of re-aggregating every raw sample, and
+so that history is kept well beyond the 100 raw entries.
+'''
+import threading
+import numpy as np
+
+try:
+    import bellhelper.redisHelper as rh
+except Exception:
+    import redisHelper as rh
+
+ROLLUPRESOLUTIONS = (1, 10, 60)
+ROLLUPMAXLEN = 1000
+# Fields describing the sample rather than counts, never summed.
+METAFIELDS = ('isTrim', 'integrationTime', 'nSamples', 'resolution',
+              'start', 'publishLatency', 'partial')
+# Slack in seconds when checking that rollup entries cover a window, for
+# the rounding of the summed integration times.
+COVERAGETOL = 1e-3
+
+
+def rollup_channel(channel, resolution):
+    return '%s:%ds' % (channel, resolution)
+
+
+def select_resolution(int_time, resolutions=ROLLUPRESOLUTIONS):
+    '''Returns the coarsest rollup resolution no longer than int_time,
+    or None if int_time is shorter than all of them.'''
+    valid = [res for res in resolutions if res <= int_time]
+    if len(valid) == 0:
+        return None
+    return max(valid)
+
+
+def add_entry(total, entry):
+    '''Adds the numeric fields of a stream entry to a running total.
+    Nested dicts are summed field by field and lists element-wise;
+    anything else (e.g. detector names) is kept from the first entry.'''
+    for key, val in entry.items():
+        if key in METAFIELDS:
+            continue
+        if isinstance(val, dict):
+            total[key] = add_entry(total.get(key, {}), val)
+        elif isinstance(val, (bool, str)) or val is None:
+            total.setdefault(key, val)
+        elif isinstance(val, (int, float, np.integer, np.floating)):
+            total[key] = total.get(key, 0) + val
+        else:
+            arr = np.asarray(val)
+            if arr.dtype.kind not in 'iuf':
+                total.setdefault(key, val)
+            elif key in total:
+                total[key] = (np.asarray(total[key]) + arr).tolist()
+            else:
+                total[key] = arr.tolist()
+    return total
+
+
+class RollupBucket():
+    """
+    Aggregate of the samples of one stream in one time bucket.
+    partial: The bucket started before the service did, so it is missing
+             the samples published before then. Published with
+             'partial': 1 so that readers don't take it for a full window.
+    """
+
+    def __init__(self, start, resolution, partial=False):
+        self.start = start
+        self.resolution = resolution
+        self.partial = partial
+        self.total = {}
+        self.nSamples = 0
+        self.nDropped = 0
+        self.integrationTime = 0.
+
+    def add(self, entry):
+        # Only trimmed samples are aggregated, as read.get_counts does by
+        # default.
+        if not entry.get('isTrim', True):
+            self.nDropped += 1
+            return
+        add_entry(self.total, entry)
+        self.nSamples += 1
+        self.integrationTime += float(entry.get('integrationTime', 0.))
+
+    def get_entry(self):
+        entry = dict(self.total)
+        entry['isTrim'] = 1
+        entry['integrationTime'] = self.integrationTime
+        entry['nSamples'] = self.nSamples
+        entry['nDropped'] = self.nDropped
+        entry['resolution'] = self.resolution
+        entry['start'] = self.start
+        entry['partial'] = int(self.partial)
+        return entry
+
+
+class RollupService():
+    """
+    Tails the given streams and publishes their aggregates at each
+    resolution in seconds. Buckets are aligned to the stream entry ids
+    (milliseconds since the epoch) and a bucket is published as soon as
+    the first entry of the next one arrives. The first bucket of each
+    stream and resolution is flagged partial. Buckets with dropped
+    (untrimmed) samples have an integrationTime short of the resolution.
+    """
+
+    def __init__(self, r, channels=('monitor:counts', 'monitor:stats'),
+                 resolutions=ROLLUPRESOLUTIONS, max_len=ROLLUPMAXLEN,
+                 binary=False):
+        self.r = rh.get_redis(r)
+        self.channels = tuple(channels)
+        self.resolutions = tuple(resolutions)
+        self.max_len = max_len
+        self.binary = binary
+        self.buckets = {}
+        self.lastIds = {}
+        # Channels whose first (partial) bucket was created, by resolution
+        self.started = {res: set() for res in self.resolutions}
+        for ch in self.channels:
+            self.buckets[ch] = {res: None for res in self.resolutions}
+            self.lastIds[ch] = '$'
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def process_entry(self, channel, entryId, entry):
+        '''Adds one raw entry and publishes any bucket it completes.'''
+        t = int(entryId.split('-')[0])/1000.
+        toPublish = {}
+        for res in self.resolutions:
+            start = int(t // res)*res
+            bucket = self.buckets[channel][res]
+            if (bucket is not None) and (bucket.start != start):
+                if bucket.nSamples > 0:
+                    toPublish[rollup_channel(channel, res)] = \
+                        bucket.get_entry()
+                bucket = None
+            if bucket is None:
+                # The first bucket of a channel misses earlier samples
+                partial = channel not in self.started[res]
+                self.started[res].add(channel)
+                bucket = RollupBucket(start, res, partial=partial)
+                self.buckets[channel][res] = bucket
+            bucket.add(entry)
+        if len(toPublish) > 0:
+            rh.send_many_to_redis(self.r, toPublish, max_len=self.max_len,
+                                  binary=self.binary, transaction=False)
+        return toPublish
+
+    def poll(self, block=1000):
+        '''Reads and processes the new entries on all channels.'''
+        msg = self.r.xread(self.lastIds, block=block)
+        if not msg:
+            return 0
+        n = 0
+        for rawData in msg:
+            channel = rawData[0].decode()
+            for entryId, entry in rh.decode_data(rawData):
+                self.lastIds[channel] = entryId
+                self.process_entry(channel, entryId, entry)
+                n += 1
+        return n
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                print('Rollup service error:', e)
+                self.stopEvent.wait(1.)
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
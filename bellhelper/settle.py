@@ -0,0 +1,55 @@
+'''
+Move-completion detection for the motor controllers. After a move the
+positions are polled until they stop changing (and, if targets are given,
+have reached them). The returned settle time can be passed to the read
+functions as loop_args['startTime'] so that only stream entries whose
+sample started after the motors stopped are counted. Stream entries are
+stamped by the redis server, so the settle time has to be taken on the
+same clock, e.g. with clock=lambda: rh.server_time(r).
+'''
+import time
+import numpy as np
+
+
+def wait_for_settle(get_positions, targets=None, target_tol=None, tol=0.,
+                    n_stable=2, poll_time=0.05, settle_time=0.,
+                    timeOut=10., clock=time.time):
+    '''
+    Polls get_positions() until the motors have stopped and returns the
+    time they settled, in seconds since the epoch, as given by clock.
+    get_positions: Function returning the current positions as a sequence.
+    targets:       Positions the motors were sent to. If given together
+                   with target_tol, the motors also have to be within
+                   target_tol of them.
+    tol:           Largest change between two polls that counts as stopped.
+    n_stable:      Number of consecutive polls without a change.
+    settle_time:   Extra time to wait after the motors stopped, e.g. for
+                   mechanical ringing to decay.
+    timeOut:       Give up after this many seconds and return the current
+                   time.
+    clock:         Function returning the time the settle time is given
+                   in. It is read after the motors were seen stopped, so
+                   the settle time is never early.
+    '''
+    t0 = time.time()
+    last = np.asarray(get_positions(), dtype=float)
+    stable = 0
+    while stable < n_stable:
+        if time.time() - t0 > timeOut:
+            print('Motors did not settle within', timeOut, 's')
+            break
+        time.sleep(poll_time)
+        pos = np.asarray(get_positions(), dtype=float)
+        moved = np.any(np.abs(pos - last) > tol)
+        onTarget = True
+        if (targets is not None) and (target_tol is not None):
+            onTarget = np.all(np.abs(pos - np.asarray(targets, dtype=float))
+                              <= target_tol)
+        if moved or not onTarget:
+            stable = 0
+        else:
+            stable += 1
+        last = pos
+    if settle_time > 0:
+        time.sleep(settle_time)
+    return clock()
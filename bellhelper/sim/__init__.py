@@ -0,0 +1,4 @@
+from .fakeRedis import FakeRedis
+from .motors import SimMotorServer, SimMotorController, SimZaberController
+from .counts import CountPublisher
+from .bench import SimBench
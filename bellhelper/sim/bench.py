@@ -0,0 +1,121 @@
+'''
+A complete simulated setup: a FakeRedis, mirror servers for the source,
+Alice and Bob, a waveplate server, the optical model and the count
+publisher. MirrorControl and PolControl objects connected to it run the
+real optimizers against the simulation:
+
+    bench = SimBench(intTime=0.05, seed=1)
+    bench.start()
+    alice = bench.mirror_control('alice')
+    alice.optimize_eff('VPath', countType='eff_a', dir='xy')
+    print(bench.get_efficiencies())
+    bench.stop()
+'''
+import numpy as np
+
+try:
+    from bellhelper.sim.fakeRedis import FakeRedis
+    from bellhelper.sim.motors import SimMotorServer, register_server
+    from bellhelper.sim.motors import SimMotorController, SimZaberController
+    from bellhelper.sim.model import MirrorCoupling, WaveplateTransmission
+    from bellhelper.sim.model import OpticalModel
+    from bellhelper.sim.counts import CountPublisher
+except Exception:
+    from fakeRedis import FakeRedis
+    from motors import SimMotorServer, register_server
+    from motors import SimMotorController, SimZaberController
+    from model import MirrorCoupling, WaveplateTransmission
+    from model import OpticalModel
+    from counts import CountPublisher
+
+MIRRORAXES = ('VPath_1x', 'VPath_1y', 'VPath_2x', 'VPath_2y')
+WAVEPLATES = ('alice_hwp', 'alice_qwp', 'bob_hwp', 'bob_qwp')
+LABS = ('source', 'alice', 'bob')
+
+
+class SimBench():
+    """
+    intTime:     Integration time of the simulated count stream.
+    misalign:    Standard deviation, in motor steps, of the initial offset
+                 of every mirror axis from its optimum.
+    width:       Gaussian width of the mirror coupling in motor steps.
+    wpMisalign:  Standard deviation of the initial waveplate offsets in
+                 degrees.
+    mirrorSpeed, waveplateSpeed: Motor speeds in steps/s and degrees/s.
+    latency:     Round-trip time of every motor server command.
+    """
+
+    def __init__(self, intTime=0.2, pairRate=50000., misalign=2000.,
+                 width=3000., wpMisalign=5., mirrorSpeed=20000.,
+                 waveplateSpeed=20., latency=0.005, ip='127.0.0.1',
+                 seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.r = FakeRedis()
+        self.ip = ip
+        self.ports = {}
+        self.servers = {}
+        couplings = {}
+        for i, lab in enumerate(LABS):
+            optimum = {name: float(self.rng.integers(-50000, 50000))
+                       for name in MIRRORAXES}
+            start = {name: float(round(opt + self.rng.normal(0, misalign)))
+                     for name, opt in optimum.items()}
+            server = SimMotorServer(start, speed=mirrorSpeed,
+                                    latency=latency, round_positions=True)
+            self.add_server(lab, 55000 + i, server)
+            couplings[lab] = MirrorCoupling(server, optimum, width=width,
+                                            peak=0.9 if lab == 'source'
+                                            else 0.8)
+        optimum = {name: float(self.rng.uniform(0, 180))
+                   for name in WAVEPLATES}
+        start = {name: opt + self.rng.normal(0, wpMisalign)
+                 for name, opt in optimum.items()}
+        server = SimMotorServer(start, speed=waveplateSpeed, latency=latency)
+        self.add_server('waveplates', 55000 + len(LABS), server)
+        self.waveplates = WaveplateTransmission(server, optimum)
+        self.couplings = couplings
+        self.model = OpticalModel(pairRate=pairRate,
+                                  alice=couplings['alice'],
+                                  bob=couplings['bob'],
+                                  source=couplings['source'],
+                                  waveplates=self.waveplates)
+        self.publisher = CountPublisher(
+            self.r, self.model, intTime=intTime,
+            seed=None if seed is None else seed + 1)
+
+    def add_server(self, name, port, server):
+        self.ports[name] = port
+        self.servers[name] = server
+        register_server(self.ip, port, server)
+
+    def start(self):
+        '''Starts publishing counts and waits for the first entries.'''
+        self.publisher.start()
+        while self.publisher.nPublished < 2:
+            self.publisher.stopEvent.wait(self.publisher.intTime/4.)
+        return self
+
+    def stop(self):
+        self.publisher.stop()
+
+    def mirror_control(self, lab, **kwargs):
+        '''A MirrorControl connected to the mirrors of lab.'''
+        from bellhelper.mirrorControl import MirrorControl
+        return MirrorControl(self.r, ip=self.ip, port=self.ports[lab],
+                             name='sim_' + lab,
+                             controllerClass=SimZaberController, **kwargs)
+
+    def pol_control(self, **kwargs):
+        '''A PolControl connected to the waveplates.'''
+        from bellhelper.polarizationControl import PolControl
+        return PolControl(self.r, ip=self.ip,
+                          port=self.ports['waveplates'],
+                          name='sim_waveplates',
+                          controller_class=SimMotorController, **kwargs)
+
+    def get_efficiencies(self):
+        '''True coupling efficiencies and waveplate transmission, for
+        judging the optimizers.'''
+        eff = {lab: c.efficiency() for lab, c in self.couplings.items()}
+        eff['waveplates'] = self.waveplates.transmission()
+        return eff
@@ -0,0 +1,79 @@
+'''
+Publishes simulated monitor:counts and monitor:stats entries with Poisson
+noise every integration time, in the same format as the timetagger
+analysis, so that read.get_power and the optimizers run unchanged.
+'''
+import threading
+import time
+import numpy as np
+
+try:
+    import bellhelper.redisHelper as rh
+    import bellhelper.read as read
+except Exception:
+    import redisHelper as rh
+    import read as read
+
+
+class CountPublisher():
+    """
+    r:         Redis connection (e.g. a FakeRedis) to publish to.
+    model:     OpticalModel giving the expected counts.
+    intTime:   Integration time of each entry in seconds.
+    countPath: Count type the counts are published under.
+    syncRate:  Rate of the sync channel (0) in the stats entries. The
+               detector is on channel 1.
+    """
+
+    def __init__(self, r, model, intTime=0.2, countPath='VV', max_len=100,
+                 syncRate=100000., seed=None):
+        self.r = r
+        self.model = model
+        self.intTime = intTime
+        self.countPath = countPath
+        self.syncRate = syncRate
+        self.max_len = max_len
+        self.rng = np.random.default_rng(seed)
+        self.nPublished = 0
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def make_entries(self):
+        sa, sb, coinc = self.model.expected_counts(self.intTime)
+        sa, sb, coinc = (int(n) for n in self.rng.poisson([sa, sb, coinc]))
+        # Entries are published as their window ends
+        counts = {self.countPath: {'As': sa, 'Bs': sb, 'C': coinc},
+                  'isTrim': 1, 'integrationTime': self.intTime,
+                  'publishLatency': 0.}
+        syncs = self.rng.poisson(self.syncRate*self.intTime, 2)
+        stats = {'alice': [int(syncs[0]), sa] + [0]*6,
+                 'bob': [int(syncs[1]), sb] + [0]*6,
+                 'integrationTime': self.intTime}
+        return counts, stats
+
+    def publish(self):
+        counts, stats = self.make_entries()
+        rh.send_many_to_redis(self.r, {read.CHANNELCOUNTS: counts,
+                                       read.CHANNELSTATS: stats},
+                              max_len=self.max_len)
+        self.nPublished += 1
+
+    def run(self):
+        # Entries are published at the end of each window, on a fixed
+        # schedule so the integration time doesn't drift.
+        tNext = time.time() + self.intTime
+        while not self.stopEvent.wait(max(tNext - time.time(), 0.)):
+            self.publish()
+            tNext += self.intTime
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
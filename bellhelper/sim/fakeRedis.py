@@ -0,0 +1,236 @@
+'''
+In-process stand-in for the redis server, implementing the subset of the
+redis-py client used by bellhelper: streams (XADD, XRANGE, XREVRANGE and
+blocking XREAD), GET/SET/INCR and pipelines, including WATCH/MULTI
+transactions. Replies use bytes, as redis-py does without
+decode_responses, so the redisHelper decoding works unchanged. Thread
+safe; blocking reads wait on a condition.
+'''
+import threading
+import time
+import redis
+
+
+def _to_bytes(val):
+    if isinstance(val, bytes):
+        return val
+    if isinstance(val, str):
+        return val.encode()
+    return str(val).encode()
+
+
+def _parse_id(entryId, default_seq=0):
+    if isinstance(entryId, bytes):
+        entryId = entryId.decode()
+    entryId = str(entryId)
+    if '-' in entryId:
+        ms, seq = entryId.split('-')
+        return (int(ms), int(seq))
+    return (int(entryId), default_seq)
+
+
+def _format_id(key):
+    return ('%d-%d' % key).encode()
+
+
+class FakeConnectionPool():
+    def __init__(self, db=0):
+        self.connection_kwargs = {'db': db}
+
+    def disconnect(self):
+        pass
+
+
+class FakePipeline():
+    """
+    Queues commands until execute. After watch, commands run immediately
+    (as in redis-py) until multi; execute then raises redis.WatchError if
+    a watched key was written in between.
+    """
+
+    def __init__(self, r):
+        self.r = r
+        self.calls = []
+        self.watched = None
+        self.immediate = False
+
+    def __getattr__(self, name):
+        method = getattr(self.r, name)
+        if self.immediate:
+            return method
+
+        def queue(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def watch(self, *names):
+        with self.r.lock:
+            self.watched = {}
+            for name in names:
+                name = _to_bytes(name)
+                self.watched[name] = self.r.versions.get(name, 0)
+        self.immediate = True
+        return True
+
+    def unwatch(self):
+        self.reset()
+        return True
+
+    def multi(self):
+        self.immediate = False
+
+    def reset(self):
+        self.calls = []
+        self.watched = None
+        self.immediate = False
+
+    def execute(self):
+        try:
+            with self.r.lock:
+                if self.watched is not None:
+                    for name, version in self.watched.items():
+                        if self.r.versions.get(name, 0) != version:
+                            raise redis.WatchError(
+                                'Watched variable changed.')
+                results = [method(*args, **kwargs)
+                           for method, args, kwargs in self.calls]
+        finally:
+            self.reset()
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+
+class FakeRedis():
+    def __init__(self, db=0):
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.streams = {}
+        self.values = {}
+        self.lastIds = {}
+        # Write count of every key, for WATCH
+        self.versions = {}
+        self.connection_pool = FakeConnectionPool(db)
+
+    def _touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def ping(self):
+        return True
+
+    def time(self):
+        t = time.time()
+        return (int(t), int((t - int(t))*1e6))
+
+    def config_get(self, pattern='*'):
+        # No keyspace notifications
+        return {'notify-keyspace-events': ''}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def expire(self, name, time):
+        return True
+
+    def get(self, name):
+        with self.lock:
+            return self.values.get(_to_bytes(name))
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[_to_bytes(name)] = _to_bytes(value)
+            self._touch(_to_bytes(name))
+        return True
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            key = _to_bytes(name)
+            val = int(self.values.get(key, b'0')) + amount
+            self.values[key] = _to_bytes(val)
+            self._touch(key)
+        return val
+
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        name = _to_bytes(name)
+        with self.condition:
+            last = self.lastIds.get(name, (0, 0))
+            if id == '*':
+                ms = int(time.time()*1000)
+                key = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+            else:
+                key = _parse_id(id)
+            entry = {_to_bytes(k): _to_bytes(v) for k, v in fields.items()}
+            stream = self.streams.setdefault(name, [])
+            stream.append((key, entry))
+            if (maxlen is not None) and (len(stream) > maxlen):
+                del stream[:len(stream) - maxlen]
+            self.lastIds[name] = key
+            self._touch(name)
+            self.condition.notify_all()
+        return _format_id(key)
+
+    def _range(self, name, lo, hi):
+        stream = self.streams.get(_to_bytes(name), [])
+        return [(_format_id(key), dict(entry)) for key, entry in stream
+                if lo <= key <= hi]
+
+    def _bound(self, bound, low):
+        if bound in ('-', b'-'):
+            return (0, 0)
+        if bound in ('+', b'+'):
+            return (float('inf'), float('inf'))
+        return _parse_id(bound, 0 if low else float('inf'))
+
+    def xrange(self, name, min='-', max='+', count=None):
+        with self.lock:
+            msg = self._range(name, self._bound(min, True),
+                              self._bound(max, False))
+        if count is not None:
+            msg = msg[:count]
+        return msg
+
+    def xrevrange(self, name, max='+', min='-', count=None):
+        with self.lock:
+            msg = self._range(name, self._bound(min, True),
+                              self._bound(max, False))[::-1]
+        if count is not None:
+            msg = msg[:count]
+        return msg
+
+    def xread(self, streams, count=None, block=None):
+        with self.condition:
+            after = {}
+            for name, lastId in streams.items():
+                name = _to_bytes(name)
+                if lastId in ('$', b'$'):
+                    after[name] = self.lastIds.get(name, (0, 0))
+                else:
+                    after[name] = _parse_id(lastId)
+
+            def collect():
+                msg = []
+                for name, key in after.items():
+                    entries = [(_format_id(k), dict(e))
+                               for k, e in self.streams.get(name, [])
+                               if k > key]
+                    if count is not None:
+                        entries = entries[:count]
+                    if len(entries) > 0:
+                        msg.append([name, entries])
+                return msg
+
+            msg = collect()
+            if (len(msg) == 0) and (block is not None):
+                deadline = time.time() + block/1000.
+                while len(msg) == 0:
+                    remaining = deadline - time.time()
+                    if (block > 0) and (remaining <= 0):
+                        break
+                    self.condition.wait(remaining if block > 0 else None)
+                    msg = collect()
+        return msg
@@ -0,0 +1,94 @@
+'''
+Response of the experiment to the simulated motors. Each lab's fiber
+coupling falls off as a Gaussian in its mirror positions, and the
+waveplates set the fraction of pairs that pass the polarizers. From these
+and the pair rate the model gives the expected singles and coincidences
+per integration window.
+'''
+import numpy as np
+
+
+class MirrorCoupling():
+    """
+    Coupling efficiency exp(-sum(((pos - optimum)/width)**2)/2)*peak of
+    the mirror axes of one server.
+    optimum: {axis name: position of peak coupling}.
+    width:   Gaussian width in motor steps, scalar or {axis name: width}.
+    """
+
+    def __init__(self, server, optimum, width=3000., peak=0.8):
+        self.server = server
+        self.optimum = dict(optimum)
+        self.width = width
+        self.peak = peak
+
+    def get_width(self, name):
+        if isinstance(self.width, dict):
+            return self.width[name]
+        return self.width
+
+    def efficiency(self):
+        pos = self.server.get_positions()
+        chi2 = sum(((pos[name] - opt)/self.get_width(name))**2
+                   for name, opt in self.optimum.items())
+        return self.peak*np.exp(-chi2/2.)
+
+
+class WaveplateTransmission():
+    """
+    Fraction of pairs passing the polarizers:
+    extinction + (1 - extinction)*(1 - prod(cos(2*(angle - optimum))**2))
+    with angles in degrees, which is minimised at the optimum angles.
+    """
+
+    def __init__(self, server, optimum, extinction=0.005):
+        self.server = server
+        self.optimum = dict(optimum)
+        self.extinction = extinction
+
+    def transmission(self):
+        pos = self.server.get_positions()
+        prod = 1.
+        for name, opt in self.optimum.items():
+            prod *= np.cos(np.radians(2*(pos[name] - opt)))**2
+        return self.extinction + (1 - self.extinction)*(1 - prod)
+
+
+class OpticalModel():
+    """
+    Expected counts per window for the monitor streams.
+    pairRate:    Pairs per second produced by the source.
+    darkRate:    Dark counts per second on each party's detector.
+    alice, bob:  Objects with an efficiency() method (e.g. MirrorCoupling)
+                 for each party's collection, or None for peak.
+    source:      Efficiency of the source coupling common to both parties.
+    waveplates:  Object with a transmission() method applied to the
+                 coincidences, or None for full transmission.
+    """
+
+    def __init__(self, pairRate=50000., darkRate=200., alice=None,
+                 bob=None, source=None, waveplates=None):
+        self.pairRate = pairRate
+        self.darkRate = darkRate
+        self.alice = alice
+        self.bob = bob
+        self.source = source
+        self.waveplates = waveplates
+
+    @staticmethod
+    def _eff(coupling, default=0.8):
+        return default if coupling is None else coupling.efficiency()
+
+    def expected_counts(self, intTime):
+        '''Returns the expected (singlesAlice, singlesBob, coincidences).'''
+        etaS = self._eff(self.source, 1.)
+        etaA = etaS*self._eff(self.alice)
+        etaB = etaS*self._eff(self.bob)
+        transmission = 1.
+        if self.waveplates is not None:
+            transmission = self.waveplates.transmission()
+        pairs = self.pairRate*intTime
+        sa = pairs*etaA + self.darkRate*intTime
+        sb = pairs*etaB + self.darkRate*intTime
+        coinc = pairs*etaA*etaB*transmission
+        return sa, sb, coinc
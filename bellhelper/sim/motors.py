@@ -0,0 +1,148 @@
+'''
+Simulated motor servers with the client APIs of bellMotors'
+MotorController (waveplates) and MotorControllerZaber (mirrors). Every
+client connection to the same (ip, port) shares one SimMotorServer, so the
+per-axis connections opened by ParallelMover see the same motors. Motors
+move at a finite speed: positions read during a move are interpolated.
+'''
+import threading
+import time
+
+# Servers by (ip, port), created with register_server
+SERVERS = {}
+SERVERLOCK = threading.Lock()
+
+
+class SimAxis():
+    def __init__(self, pos=0., speed=1.):
+        self.start = float(pos)
+        self.target = float(pos)
+        self.tStart = 0.
+        self.speed = float(speed)
+
+    def get_position(self, t=None):
+        if t is None:
+            t = time.time()
+        distance = self.target - self.start
+        duration = abs(distance)/self.speed
+        if (duration == 0) or (t - self.tStart >= duration):
+            return self.target
+        return self.start + distance*(t - self.tStart)/duration
+
+    def move_to(self, pos):
+        '''Starts a move and returns its duration in seconds.'''
+        now = time.time()
+        self.start = self.get_position(now)
+        self.target = float(pos)
+        self.tStart = now
+        return abs(self.target - self.start)/self.speed
+
+
+class SimMotorServer():
+    """
+    axes:     {name: initial position}.
+    speed:    Motor speed in position units per second.
+    latency:  Round-trip time of every command in seconds.
+    """
+
+    def __init__(self, axes, speed=1., latency=0.005, round_positions=False):
+        self.axes = {name: SimAxis(pos, speed) for name, pos in axes.items()}
+        self.latency = latency
+        self.round_positions = round_positions
+        self.lock = threading.Lock()
+        self.nCommands = 0
+
+    def command(self):
+        with self.lock:
+            self.nCommands += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get_position(self, name):
+        self.command()
+        pos = self.axes[name].get_position()
+        if self.round_positions:
+            return int(round(pos))
+        return pos
+
+    def move_to(self, name, pos):
+        self.command()
+        with self.lock:
+            return self.axes[name].move_to(pos)
+
+    def get_positions(self):
+        '''Actual (not reported) positions, for the count models.'''
+        return {name: axis.get_position() for name, axis in self.axes.items()}
+
+
+def register_server(ip, port, server):
+    with SERVERLOCK:
+        SERVERS[(ip, int(port))] = server
+    return server
+
+
+def get_server(ip, port):
+    with SERVERLOCK:
+        server = SERVERS.get((ip, int(port)))
+    if server is None:
+        raise ConnectionError('No simulated motor server at %s:%s' %
+                              (ip, port))
+    return server
+
+
+class SimMotorController():
+    """Client of a simulated waveplate server, with the MotorController
+    API. goto blocks until the move is finished."""
+
+    def __init__(self, ip='127.0.0.1', port=55000):
+        self.server = get_server(ip, port)
+
+    def getAllPos(self):
+        self.server.command()
+        return {name: axis.get_position()
+                for name, axis in self.server.axes.items()}
+
+    def getPos(self, name):
+        return self.server.get_position(name)
+
+    def goto(self, name, pos):
+        duration = self.server.move_to(name, pos)
+        time.sleep(duration)
+
+    def forward(self, name, delta):
+        self.goto(name, self.server.axes[name].get_position() + delta)
+
+    def home(self, name):
+        self.goto(name, 0.)
+
+    def getYaml(self):
+        return '\n'.join('%s: %s' % (name, pos)
+                         for name, pos in self.getAllPos().items())
+
+
+class SimZaberController():
+    """Client of a simulated mirror server, with the MotorControllerZaber
+    API. Axes are named '<path>_<mirror><dir>', e.g. 'VPath_1x', and
+    numbered from 1 in that order. Moves return immediately."""
+
+    def __init__(self, ip='127.0.0.1', port=55000):
+        self.server = get_server(ip, port)
+        self.channelNames = list(self.server.axes.keys())
+        self.channels = list(range(1, len(self.channelNames) + 1))
+
+    def _name(self, ch):
+        return self.channelNames[int(ch) - 1]
+
+    def potentiometer_all_enabled(self, enabled):
+        self.server.command()
+
+    def get_position(self, ch):
+        return self.server.get_position(self._name(ch))
+
+    def move_absolute(self, ch, pos):
+        self.server.move_to(self._name(ch), pos)
+
+    def move_relative(self, ch, delta):
+        name = self._name(ch)
+        self.server.move_to(name,
+                            self.server.axes[name].get_position() + delta)
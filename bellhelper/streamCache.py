@@ -0,0 +1,188 @@
+'''
+In-process cache of the monitor streams. A single background reader tails
+each stream once and keeps the decoded entries in a ring buffer, so that
+several optimizers or dashboards in the same process can wait for and
+aggregate samples without each polling and decoding the stream itself.
+'''
+import collections
+import math
+import threading
+
+try:
+    import bellhelper.redisHelper as rh
+    import bellhelper.streamExceptions as stExcept
+except Exception:
+    import redisHelper as rh
+    import streamExceptions as stExcept
+
+# Caches shared by every caller in the process, keyed by connection pool.
+STREAMCACHES = {}
+CACHELOCK = threading.Lock()
+
+
+def parse_id(entryId):
+    '''Stream entry id as a tuple that sorts in stream order.'''
+    ms, seq = entryId.split('-')
+    return (int(ms), int(seq))
+
+
+class StreamCache():
+    """
+    Tails channels with one blocking XREAD loop and keeps the last maxLen
+    decoded entries of each. Readers wait on a condition that is notified
+    whenever new entries arrive.
+    """
+
+    def __init__(self, r, channels, maxLen=600, blockTime=1.):
+        self.r = rh.get_redis(r)
+        self.channels = tuple(channels)
+        self.maxLen = maxLen
+        self.blockTime = blockTime
+        self.buffers = {ch: collections.deque(maxlen=maxLen)
+                        for ch in self.channels}
+        self.lastIds = {ch: '$' for ch in self.channels}
+        self.condition = threading.Condition()
+        self.stopEvent = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def poll(self, block=None):
+        '''Reads the new entries of all channels into the buffers.'''
+        if block is None:
+            block = max(int(1000*self.blockTime), 1)
+        msg = self.r.xread(self.lastIds, block=block)
+        if not msg:
+            return 0
+        n = 0
+        with self.condition:
+            for rawData in msg:
+                channel = rawData[0].decode()
+                for entryId, entry in rh.decode_data(rawData):
+                    self.buffers[channel].append(
+                        (parse_id(entryId), entryId, entry))
+                    self.lastIds[channel] = entryId
+                    n += 1
+            self.condition.notify_all()
+        return n
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                self.poll()
+                self.error = None
+            except Exception as e:
+                self.error = e
+                print('Stream cache error:', e)
+                self.stopEvent.wait(self.blockTime)
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def is_running(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def get_last_entry(self, channel):
+        '''The newest (id, entry) of channel, read from redis if nothing
+        has been cached yet.'''
+        with self.condition:
+            if len(self.buffers[channel]) > 0:
+                _, entryId, entry = self.buffers[channel][-1]
+                return entryId, entry
+        msg = rh.get_last_entry(self.r, channel, count=1)
+        if msg is None:
+            return None
+        return msg[0]
+
+    def get_entries_after(self, channel, entryId):
+        '''Cached (id, entry) pairs of channel newer than entryId.'''
+        ref = parse_id(entryId)
+        newer = []
+        with self.condition:
+            for key, eId, entry in reversed(self.buffers[channel]):
+                if key <= ref:
+                    break
+                newer.append((eId, entry))
+        newer.reverse()
+        return newer
+
+    def loop_counts(self, channel, error_function, errorArgs, intTime=0.2,
+                    numTries=-1, sleepTime=0.05, timeOut=None, block=True,
+                    blockTime=None, startTime=None):
+        '''
+        Same as redisHelper.loop_counts, but served from the cache. The
+        first entry to arrive after the call is only used as the reference
+        for the next one. Readers always wait on the cache, as with
+        block=True, so numTries stands for numTries*sleepTime seconds
+        without a new entry. block is accepted for compatibility.
+        '''
+        if channel not in self.buffers:
+            raise KeyError('Channel not cached: ' + channel)
+        last = self.get_last_entry(channel)
+        if last is None:
+            raise stExcept.StreamFrozenException(channel, numTries=0,
+                                                 timeElapsed=0)
+        lastTimeStamp = last[0]
+        defaultIntegrationTime = last[1]['integrationTime']
+        nSamples = int(math.ceil(float(intTime) /
+                                 float(defaultIntegrationTime)))
+        if blockTime is None:
+            blockTime = 2.*float(defaultIntegrationTime)
+
+        watchdog = rh.ReadWatchdog(channel, numTries=numTries,
+                                   timeOut=timeOut, sleepTime=sleepTime,
+                                   block=True)
+        countList = []
+        previousCounts = None
+        while len(countList) < nSamples:
+            wait = watchdog.wait_time(blockTime)
+            with self.condition:
+                newEntries = self.get_entries_after(channel, lastTimeStamp)
+                if len(newEntries) == 0:
+                    self.condition.wait(wait)
+                    newEntries = self.get_entries_after(channel,
+                                                        lastTimeStamp)
+
+            if len(newEntries) == 0:
+                watchdog.empty_read()
+                continue
+
+            watchdog.new_entries()
+            previousCounts, lastTimeStamp = rh.filter_samples(
+                newEntries, previousCounts, error_function, errorArgs,
+                countList, nSamples, startTime=startTime)
+
+        return countList
+
+
+def get_stream_cache(r, channels=None, maxLen=600):
+    '''Returns the running cache for the server of r, starting one for
+    channels if there is none. Returns None if there is no cache and no
+    channels are given.'''
+    r = rh.get_redis(r)
+    key = id(r.connection_pool)
+    with CACHELOCK:
+        cache = STREAMCACHES.get(key)
+        if cache is None:
+            if channels is None:
+                return None
+            cache = StreamCache(r, channels, maxLen=maxLen)
+            cache.start()
+            STREAMCACHES[key] = cache
+    return cache
+
+
+def stop_stream_cache(r):
+    r = rh.get_redis(r)
+    with CACHELOCK:
+        cache = STREAMCACHES.pop(id(r.connection_pool), None)
+    if cache is not None:
+        cache.stop()
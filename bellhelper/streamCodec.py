@@ -0,0 +1,129 @@
+'''
+Compact binary encoding for the entries of the monitor streams
+(monitor:counts, monitor:stats and monitor:violationstats).
+
+Each field of an entry is packed as a one byte type tag followed by a
+fixed little-endian layout:
+    'T'/'F'  booleans
+    'i'      int64 scalar
+    'f'      float64 scalar
+    'a'      numeric array: dtype ('i' int64 or 'f' float64), number of
+             dimensions (uint8), shape (uint32 each), then the raw data
+    'r'      dictionary of numeric scalars with str keys that contain no
+             commas: dtype, length of the comma-separated key names
+             (uint16), the names, then the values as one array
+    'j'      anything else as JSON
+Entries carry a version field so that decode can tell them apart from
+the JSON encoded entries and fall back automatically. Arrays decode to
+(nested) lists, as they do from JSON.
+'''
+import json
+import struct
+import numpy as np
+
+VERSIONFIELD = '_bin'
+VERSION = 1
+
+_DTYPES = {b'i': np.dtype('<i8'), b'f': np.dtype('<f8')}
+
+
+def _is_number(val):
+    return (isinstance(val, (int, float, np.integer, np.floating)) and
+            not isinstance(val, (bool, np.bool_)))
+
+
+def _is_record(val):
+    '''True if a dict can be packed as an 'r' record.'''
+    return (len(val) > 0 and
+            all(isinstance(k, str) and (',' not in k) for k in val.keys())
+            and all(_is_number(v) for v in val.values()))
+
+
+def _dtype_code(kind):
+    if kind in 'iub':
+        return b'i'
+    return b'f'
+
+
+def encode_value(val):
+    if isinstance(val, (bool, np.bool_)):
+        return b'T' if val else b'F'
+    if isinstance(val, (int, np.integer)):
+        return b'i' + struct.pack('<q', int(val))
+    if isinstance(val, (float, np.floating)):
+        return b'f' + struct.pack('<d', float(val))
+    if isinstance(val, dict):
+        if _is_record(val):
+            names = ','.join(val.keys()).encode()
+            if len(names) <= 0xFFFF:
+                arr = np.array(list(val.values()))
+                code = _dtype_code(arr.dtype.kind)
+                arr = arr.astype(_DTYPES[code])
+                return (b'r' + code + struct.pack('<H', len(names)) +
+                        names + arr.tobytes())
+        return b'j' + json.dumps(val).encode()
+    try:
+        arr = np.asarray(val)
+    except Exception:
+        arr = None
+    if (arr is not None) and (arr.ndim >= 1) and (arr.dtype.kind in 'iuf'):
+        code = _dtype_code(arr.dtype.kind)
+        arr = arr.astype(_DTYPES[code])
+        header = struct.pack('<B', arr.ndim)
+        header += struct.pack('<%dI' % arr.ndim, *arr.shape)
+        return b'a' + code + header + arr.tobytes()
+    return b'j' + json.dumps(val).encode()
+
+
+def decode_value(buf):
+    tag = buf[0:1]
+    if tag == b'T':
+        return True
+    if tag == b'F':
+        return False
+    if tag == b'i':
+        return struct.unpack('<q', buf[1:9])[0]
+    if tag == b'f':
+        return struct.unpack('<d', buf[1:9])[0]
+    if tag == b'a':
+        dtype = _DTYPES[buf[1:2]]
+        ndim = buf[2]
+        shape = struct.unpack('<%dI' % ndim, buf[3:3+4*ndim])
+        arr = np.frombuffer(buf, dtype=dtype, offset=3+4*ndim)
+        return arr.reshape(shape).tolist()
+    if tag == b'r':
+        dtype = _DTYPES[buf[1:2]]
+        nNames = struct.unpack('<H', buf[2:4])[0]
+        names = buf[4:4+nNames].decode().split(',')
+        vals = np.frombuffer(buf, dtype=dtype, offset=4+nNames).tolist()
+        return dict(zip(names, vals))
+    if tag == b'j':
+        return json.loads(buf[1:].decode())
+    raise ValueError('Unknown binary field type: ' + str(tag))
+
+
+def encode_dict(data):
+    '''Returns the fields of a stream entry in the binary encoding.'''
+    encoded = {VERSIONFIELD: str(VERSION)}
+    for key in data.keys():
+        encoded[key] = encode_value(data[key])
+    return encoded
+
+
+def is_binary(rawDict):
+    '''True if a raw entry read from redis was written with encode_dict.'''
+    return VERSIONFIELD.encode() in rawDict
+
+
+def decode_dict(rawDict):
+    version = int(rawDict[VERSIONFIELD.encode()])
+    if version != VERSION:
+        raise ValueError('Unsupported binary stream entry version: ' +
+                         str(version))
+    retDict = {}
+    for key, val in rawDict.items():
+        key = key.decode()
+        if key == VERSIONFIELD:
+            continue
+        retDict[key] = decode_value(val)
+    return retDict
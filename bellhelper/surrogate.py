@@ -0,0 +1,188 @@
+'''
+Surrogate-model optimizer for the alignment objectives. Each measurement
+costs a move, settling and an integration, so instead of spending them on
+simplex steps a quadratic model is fitted to every measurement around the
+current point and the next move is taken to the model's minimum inside a
+trust region.
+
+With model='gaussian' the quadratic is fitted to log(f) instead of f.
+For the alignment objectives f = 1/(counts + 1), this is a Gaussian
+model of the coupled counts, and the fit is weighted by their Poisson
+variance.
+
+minimize_surrogate follows the scipy custom-method interface, so it can be
+used as scipy.optimize.minimize(fun, x0, args, method=minimize_surrogate,
+options={...}).
+'''
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+
+def quadratic_features(x):
+    '''Design matrix [1, x_i, x_i*x_j (i <= j)] for points x (m, n).'''
+    x = np.atleast_2d(x)
+    n = x.shape[1]
+    iu, ju = np.triu_indices(n)
+    return np.hstack([np.ones((len(x), 1)), x, x[:, iu]*x[:, ju]])
+
+
+def fit_quadratic(x, y, weights=None):
+    '''
+    Weighted least-squares fit of y = c + g.x + x.H.x/2. Returns (c, g, H).
+    Falls back to a separable (diagonal) quadratic if there are too few
+    points for the full one.
+    '''
+    x = np.atleast_2d(x)
+    n = x.shape[1]
+    if weights is None:
+        weights = np.ones(len(y))
+    sw = np.sqrt(weights)
+    full = len(y) >= 1 + n + n*(n + 1)//2
+    if full:
+        A = quadratic_features(x)
+    else:
+        A = np.hstack([np.ones((len(x), 1)), x, x**2])
+    coef = np.linalg.lstsq(A*sw[:, None], y*sw, rcond=None)[0]
+    c = coef[0]
+    g = coef[1:n + 1]
+    H = np.zeros((n, n))
+    if full:
+        iu, ju = np.triu_indices(n)
+        H[iu, ju] = coef[n + 1:]
+        H = H + H.T
+    else:
+        H[np.diag_indices(n)] = 2*coef[n + 1:]
+    return c, g, H
+
+
+def propose_step(g, H, radius):
+    '''Minimiser of g.s + s.H.s/2 for |s| <= radius (approximately).'''
+    try:
+        eig = np.linalg.eigvalsh(H)
+        if np.all(eig > 0):
+            step = -np.linalg.solve(H, g)
+            norm = np.linalg.norm(step)
+            if norm <= radius:
+                return step
+            return step*radius/norm
+    except np.linalg.LinAlgError:
+        pass
+    # Not convex: move to the edge of the trust region downhill
+    norm = np.linalg.norm(g)
+    if norm == 0:
+        return np.zeros_like(g)
+    return -g*radius/norm
+
+
+def minimize_surrogate(fun, x0, args=(), maxfev=40, initial_step=0.00025,
+                       xtol=None, model='quadratic', max_radius=None,
+                       callback=None, **unknown_options):
+    '''
+    fun:          Objective to minimise, fun(x, *args).
+    maxfev:       Maximum number of measurements.
+    initial_step: Initial trust radius, and the size of the first steps
+                  along each axis. The default matches the step
+                  Nelder-Mead takes from a zero start point.
+    xtol:         Stop once the trust radius falls below this.
+                  Defaults to initial_step/16.
+    model:        'quadratic' fits f, 'gaussian' fits log(f) for positive
+                  objectives of the form 1/(counts + 1).
+    max_radius:   Largest trust radius. Defaults to 8*initial_step.
+    Other scipy options (e.g. ftol) are ignored.
+    '''
+    x0 = np.asarray(x0, dtype=float).ravel()
+    n = len(x0)
+    if xtol is None:
+        xtol = initial_step/16.
+    if max_radius is None:
+        max_radius = 8*initial_step
+    if not isinstance(args, tuple):
+        args = (args,)
+
+    X = []
+    F = []
+
+    def evaluate(x):
+        f = float(fun(np.array(x), *args))
+        X.append(np.array(x))
+        F.append(f)
+        return f
+
+    def model_values(f):
+        f = np.asarray(f, dtype=float)
+        if model == 'gaussian':
+            return np.log(np.maximum(f, 1e-300))
+        return f
+
+    def model_weights(f):
+        if model == 'gaussian':
+            # var(log(1/f)) ~ 1/counts ~ f for Poisson counts
+            return 1./np.maximum(np.asarray(f, dtype=float), 1e-12)
+        return np.ones(len(f))
+
+    # Initial design: the start point and one step either way on each axis
+    evaluate(x0)
+    for i in range(n):
+        for sign in (1, -1):
+            if len(F) >= maxfev:
+                break
+            x = x0.copy()
+            x[i] += sign*initial_step
+            evaluate(x)
+
+    radius = initial_step
+    nit = 0
+    message = 'Maximum number of function evaluations reached.'
+    while len(F) < maxfev:
+        nit += 1
+        Xa = np.array(X)
+        Fa = np.array(F)
+        # Fit in coordinates centred on the best measurement and scaled by
+        # the trust radius, using the measurements nearby.
+        origin = Xa[np.argmin(Fa)]
+        dist = np.linalg.norm(Xa - origin, axis=1)
+        near = np.flatnonzero(dist <= 4*max(radius, initial_step))
+        if len(near) < 2*n + 1:
+            near = np.argsort(dist)[:2*n + 1]
+        z = (Xa[near] - origin)/radius
+        c, g, H = fit_quadratic(z, model_values(Fa[near]),
+                                model_weights(Fa[near]))
+
+        def predict(zi):
+            return c + g.dot(zi) + 0.5*zi.dot(H).dot(zi)
+
+        # The incumbent is the measured point the model rates best, which
+        # is less sensitive to a single noisy measurement.
+        zc = z[np.argmin([predict(zi) for zi in z])]
+        fc = predict(zc)
+        dz = propose_step(g + H.dot(zc), H, 1.)
+        if np.linalg.norm(dz)*radius < xtol:
+            message = 'Surrogate minimum reached.'
+            break
+        zNew = zc + dz
+        fNew = model_values(evaluate(origin + radius*zNew))
+        predictedGain = fc - predict(zNew)
+        actualGain = fc - fNew
+        if (predictedGain > 0) and (actualGain > 0.5*predictedGain):
+            # The model predicted the improvement well: trust it further
+            radius = min(2*radius, max_radius)
+        elif actualGain <= 0:
+            radius = 0.5*radius
+        if callback is not None:
+            callback(np.array(X[int(np.argmin(F))]))
+        if radius < xtol:
+            message = 'Trust radius below xtol.'
+            break
+
+    iBest = int(np.argmin(F))
+    return OptimizeResult(x=np.array(X[iBest]), fun=F[iBest], nfev=len(F),
+                          nit=nit, success=True, message=message,
+                          allvecs=np.array(X), allvals=np.array(F))
+
+
+def resolve_method(method):
+    '''Maps the method name 'surrogate' to minimize_surrogate, so that
+    optimizers can pass any name straight to scipy.optimize.minimize.'''
+    if isinstance(method, str) and method.lower() == 'surrogate':
+        return minimize_surrogate
+    return method
@@ -7,7 +7,7 @@ setup(name='bellhelper',
       author='Krister Shalm, Gautam Kavuri',
       author_email='lks@nist.gov',
       license='MIT',
-      packages=['bellhelper', 'bellhelper.data'],
+      packages=['bellhelper', 'bellhelper.data', 'bellhelper.sim'],
       install_requires=['pyyaml',
                         'bellMotors @ git+https://github.com/kshalm/motorLib.git#egg=bellMotors',
                         'zmqhelper @ git+https://github.com/kshalm/zmqhelpers.git#egg=zmqhelper',
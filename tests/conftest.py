@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+import bellhelper.read as read
+import bellhelper.redisHelper as rh
+from bellhelper.sim import FakeRedis
+
+
+class StepPublisher():
+    '''Publishes counts entries with increasing counts every intTime.'''
+
+    def __init__(self, r, intTime=0.02, publishLatency=0.):
+        self.r = r
+        self.intTime = intTime
+        self.publishLatency = publishLatency
+        self.n = 0
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def publish(self):
+        self.n += 1
+        counts = {'VV': {'As': 100 + self.n, 'Bs': 200 + self.n,
+                         'C': 10 + self.n},
+                  'isTrim': 1, 'integrationTime': self.intTime,
+                  'publishLatency': self.publishLatency}
+        rh.send_to_redis(self.r, read.CHANNELCOUNTS, counts, max_len=1000)
+
+    def run(self):
+        while not self.stopEvent.wait(self.intTime):
+            self.publish()
+
+    def __enter__(self):
+        self.publish()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopEvent.set()
+        self.thread.join()
+
+
+@pytest.fixture
+def r():
+    return FakeRedis()
+
+
+@pytest.fixture
+def no_publish_margin(monkeypatch):
+    # The simulated publishers report their whole latency
+    monkeypatch.setattr(rh, 'PUBLISHLATENCY', 0.)
@@ -0,0 +1,33 @@
+import bellhelper.read as read
+import bellhelper.redisHelper as rh
+
+CONFIGKEY = 'config:timetaggers'
+
+
+def test_set_integration_time(r):
+    rh.set_config(r, {'INT_TIME': 0.2, 'pockelProp': {'start': 1,
+                                                      'length': 2}},
+                  CONFIGKEY)
+    assert read.set_integration_time(r, 0.5, CONFIGKEY) == 0.2
+    assert read.get_integration_time(r, CONFIGKEY) == 0.5
+    assert read.set_get_pockels_window(r, CONFIGKEY, p_start=5) == (5, 2)
+    assert rh.get_config(r, CONFIGKEY)['pockelProp'] == {'start': 5,
+                                                         'length': 2}
+
+
+def test_update_retries_after_concurrent_write(r):
+    rh.set_config(r, {'INT_TIME': 0.2, 'other': 1}, CONFIGKEY)
+    client = rh.get_config_client(r, CONFIGKEY)
+    nCalls = []
+
+    def modify(config):
+        nCalls.append(1)
+        if len(nCalls) == 1:
+            # Another client writes between the read and the write
+            rh.set_config(r, dict(config, other=2), CONFIGKEY)
+        config['INT_TIME'] = 0.4
+        return config
+
+    client.update(modify)
+    assert len(nCalls) == 2
+    assert rh.get_config(r, CONFIGKEY) == {'INT_TIME': 0.4, 'other': 2}
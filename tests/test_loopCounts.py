@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+import bellhelper.read as read
+import bellhelper.redisHelper as rh
+import bellhelper.streamExceptions as stExcept
+from bellhelper.streamCache import StreamCache
+
+from conftest import StepPublisher
+
+ERRARGS = {'count_path': 'VV', 'include_null_counts': False, 'trim': True}
+
+
+def test_loop_counts_covers_int_time(r):
+    with StepPublisher(r, intTime=0.02):
+        countList = rh.loop_counts(r, read.CHANNELCOUNTS,
+                                   read.error_check_counts, ERRARGS,
+                                   intTime=0.1, timeOut=5.)
+    assert len(countList) == 5
+
+
+def test_start_time_gate(r, no_publish_margin):
+    with StepPublisher(r, intTime=0.02) as pub:
+        time.sleep(0.1)
+        startTime = rh.server_time(r) + 0.1
+        nBefore = pub.n
+        countList = rh.loop_counts(r, read.CHANNELCOUNTS,
+                                   read.error_check_counts, ERRARGS,
+                                   intTime=0.06, timeOut=5.,
+                                   startTime=startTime)
+    entries = rh.get_range(r, read.CHANNELCOUNTS, 0, time.time() + 1)
+    starts = {entry['VV']['C']: rh.sample_start_time(timeStamp, entry)
+              for timeStamp, entry in entries}
+    assert len(countList) == 3
+    for counts in countList:
+        assert counts['VV']['C'] > 10 + nBefore
+        assert starts[counts['VV']['C']] >= startTime
+
+
+def test_publish_margin_is_added(r):
+    counts = {'integrationTime': 0.2, 'publishLatency': 0.1}
+    start = rh.sample_start_time('10000-0', counts)
+    assert start == pytest.approx(10. - 0.2 - 0.1 - rh.PUBLISHLATENCY)
+
+
+def test_frozen_stream_detected_after_poll_time(r):
+    rh.send_to_redis(r, read.CHANNELCOUNTS,
+                     {'VV': {'As': 1, 'Bs': 1, 'C': 1}, 'isTrim': 1,
+                      'integrationTime': 0.2})
+    t0 = time.time()
+    with pytest.raises(stExcept.StreamFrozenException):
+        rh.loop_counts(r, read.CHANNELCOUNTS, read.error_check_counts,
+                       ERRARGS, intTime=0.2, numTries=4, sleepTime=0.05)
+    # numTries*sleepTime, not numTries blocks of 2*integrationTime
+    assert time.time() - t0 < 0.4
+
+
+def test_stream_cache_matches_loop_counts(r):
+    cache = StreamCache(r, [read.CHANNELCOUNTS], blockTime=0.05)
+    cache.start()
+    try:
+        with StepPublisher(r, intTime=0.02):
+            countList = cache.loop_counts(read.CHANNELCOUNTS,
+                                          read.error_check_counts, ERRARGS,
+                                          intTime=0.1, timeOut=5.)
+    finally:
+        cache.stop()
+    assert len(countList) == 5
+    c = [counts['VV']['C'] for counts in countList]
+    assert c == list(range(c[0], c[0] + 5))
@@ -0,0 +1,24 @@
+from bellhelper.sim import SimBench
+
+# Coincidences are suppressed by the simulated polarizers, so the mirrors
+# are aligned on Alice's singles.
+
+
+def test_optimize_eff_improves_coupling(monkeypatch, tmp_path,
+                                        no_publish_margin):
+    monkeypatch.chdir(tmp_path)
+    bench = SimBench(intTime=0.02, pairRate=200000., misalign=1500.,
+                     latency=0., mirrorSpeed=1e6, seed=3)
+    bench.start()
+    try:
+        alice = bench.mirror_control('alice')
+        alice.intTime = 0.1
+        alice.settleArgs['poll_time'] = 0.01
+        before = bench.get_efficiencies()['alice']
+        alice.optimize_eff('VPath', countType='SA', dir='xy',
+                           method='surrogate')
+        after = bench.get_efficiencies()['alice']
+    finally:
+        bench.stop()
+    # Starts at 0.18 of the 0.8 peak with this seed
+    assert after > before + 0.3
@@ -0,0 +1,50 @@
+import numpy as np
+
+import bellhelper.read as read
+import bellhelper.rollup as rollup
+
+
+def make_entry(n=1):
+    return {'VV': {'As': 10*n, 'Bs': 20*n, 'C': n}, 'isTrim': 1,
+            'integrationTime': 0.2}
+
+
+def feed(service, t0, n, dt=0.2):
+    for i in range(n):
+        entryId = '%d-0' % int(round(1000*(t0 + i*dt)))
+        service.process_entry(read.CHANNELCOUNTS, entryId, make_entry())
+
+
+def test_first_bucket_is_partial(r):
+    service = rollup.RollupService(r, channels=(read.CHANNELCOUNTS,),
+                                   resolutions=(1,))
+    # Starts halfway through a bucket
+    feed(service, 1000.5, 16)
+    entries = r.xrange(rollup.rollup_channel(read.CHANNELCOUNTS, 1))
+    assert len(entries) == 3
+    decoded = [read.rh.decode_dict(e[1]) for e in entries]
+    assert decoded[0]['partial'] == 1
+    assert [d['partial'] for d in decoded[1:]] == [0, 0]
+    assert decoded[1]['nSamples'] == 5
+    assert decoded[1]['VV'] == {'As': 50, 'Bs': 100, 'C': 5}
+
+
+def test_rollup_entries_cover_int_time(r):
+    service = rollup.RollupService(r, channels=(read.CHANNELCOUNTS,),
+                                   resolutions=(1,))
+    feed(service, 1000., 21)
+    entries = read.get_rollup_entries(r, read.CHANNELCOUNTS, 1.5)
+    assert len(entries) == 2
+    assert sum(e['integrationTime'] for e in entries) >= 1.5
+    # Only partial data back to the start of the service
+    assert read.get_rollup_entries(r, read.CHANNELCOUNTS, 10.) is None
+
+
+def test_get_range_bins(r):
+    for i in range(10):
+        r.xadd(read.CHANNELCOUNTS, read.rh.encode_entry(make_entry(i + 1)),
+               id='%d-0' % (1000000 + 200*i))
+    res = read.get_range(r, 1000., 1002., bin_width=1.)
+    assert res['nSamples'].tolist() == [5, 5]
+    assert res['Coinc'].tolist() == [15, 40]
+    assert np.allclose(res['intTime'], [1., 1.])
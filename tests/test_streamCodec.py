@@ -0,0 +1,40 @@
+import numpy as np
+
+import bellhelper.redisHelper as rh
+import bellhelper.streamCodec as codec
+
+
+def roundtrip(data):
+    encoded = codec.encode_dict(data)
+    raw = {k.encode(): v if isinstance(v, bytes) else v.encode()
+           for k, v in encoded.items()}
+    return codec.decode_dict(raw)
+
+
+def test_scalars_and_records():
+    data = {'isTrim': True, 'n': 3, 'integrationTime': 0.2,
+            'VV': {'As': 10, 'Bs': 20, 'C': 5}, 'name': 'alice'}
+    assert roundtrip(data) == data
+
+
+def test_arrays_decode_to_lists():
+    data = {'alice': [1, 2, 3], 'm': np.arange(6.).reshape(2, 3)}
+    decoded = roundtrip(data)
+    assert decoded['alice'] == [1, 2, 3]
+    assert decoded['m'] == [[0., 1., 2.], [3., 4., 5.]]
+    assert isinstance(decoded['m'], list)
+
+
+def test_unsafe_record_keys_fall_back_to_json():
+    assert codec.encode_value({1: 2, 3: 4})[:1] == b'j'
+    assert roundtrip({'d': {1: 2}}) == {'d': {'1': 2}}
+    data = {'d': {'a,b': 1, 'c': 2}}
+    assert roundtrip(data) == data
+
+
+def test_binary_stream_entries(r):
+    data = {'VV': {'As': 1, 'Bs': 2, 'C': 3}, 'alice': [4, 5]}
+    rh.send_to_redis(r, 'test', data, binary=True)
+    rh.send_to_redis(r, 'test', data)
+    entries = rh.get_last_entry(r, 'test', count=2)
+    assert [entry for timeStamp, entry in entries] == [data, data]